@@ -0,0 +1,255 @@
+"""Times the pricing, folding and history hot paths on synthetic data.
+
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Runs from the repository root. The reference and store DBs are generated
+into a temporary directory unless --data-dir is given, in which case they
+are reused between runs with the same shape.
+"""
+import argparse
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from benchmarks import synthetic
+from eve import db, market, world
+
+import reactor
+
+# A benchmark this much slower than its baseline counts as a regression.
+REGRESSION_THRESHOLD = 1.2
+ORDER_BOOK_SIZE = 100_000
+
+
+@dataclasses.dataclass(frozen=True)
+class Timing:
+    name: str
+    runs: int
+    min: float
+    median: float
+
+
+def measure(name: str, fn: Callable[[], Any], repeat: int) -> Timing:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    timing = Timing(name, repeat, min(times), statistics.median(times))
+    logging.info("%-28s %10.4fs", name, timing.min)
+    return timing
+
+
+def prepare_data(
+    data_dir: str, shape: synthetic.Shape
+) -> Tuple[synthetic.Universe, str, str]:
+    """Generates the DBs for a shape, returning them and their paths."""
+    tag = "-".join(str(v) for v in dataclasses.astuple(shape))
+    reference_path = os.path.join(data_dir, f"reference-{tag}.sqlite")
+    store_path = os.path.join(data_dir, f"store-{tag}.sqlite")
+    # The reference DB is quick to make and the universe comes with it;
+    # history takes a while, so a kept store is reused.
+    if os.path.exists(reference_path):
+        os.remove(reference_path)
+    universe = synthetic.create_reference_db(reference_path, shape)
+    if not os.path.exists(store_path):
+        logging.info("generating %d days of history", shape.days)
+        synthetic.create_store_db(store_path, universe, shape)
+    return universe, reference_path, store_path
+
+
+def run_benchmarks(
+    data_dir: str, shape: synthetic.Shape, repeat: int
+) -> List[Timing]:
+    universe, reference_path, store_path = prepare_data(data_dir, shape)
+    store = db.ConnectionPool(store_path)
+    w = world.World(db.connect_reference(reference_path), preload=True)
+    blueprints = [w.find_item_type(id) for id in universe.blueprint_ids]
+    timings = []
+
+    def find_formulas() -> List[world.Formula]:
+        return [w.find_formula(bp) for bp in blueprints]
+
+    timings.append(measure("find_formula", find_formulas, repeat))
+    formulas = find_formulas()
+    timings.append(
+        measure(
+            "fold_all_formulas",
+            lambda: reactor.fold_all_formulas(formulas),
+            repeat,
+        )
+    )
+    timings.append(
+        measure(
+            "fold_all_formulas_full",
+            lambda: reactor.fold_all_formulas(formulas, only_full_folds=True),
+            repeat,
+        )
+    )
+    # What history() backtests.
+    folds = reactor.fold_all_formulas(formulas, only_full_folds=True)
+
+    def read_histories() -> Dict[int, market.PriceSeries]:
+        return market.read_histories(
+            store.reader(), universe.traded_ids, None, None
+        )
+
+    timings.append(measure("read_histories", read_histories, repeat))
+    hist = {w.find_item_type(id): s for id, s in read_histories().items()}
+    dates = reactor.get_common_dates(hist)
+    last_date = dates[-1]
+    timings.append(
+        measure(
+            "get_price_snapshot",
+            lambda: reactor.get_price_snapshot(hist, last_date),
+            repeat,
+        )
+    )
+    ips = reactor.get_price_snapshot(hist, last_date)
+
+    def price_all():
+        for name, f in folds:
+            reactor.price_formula(ips, name, f)
+
+    timings.append(measure("price_formula", price_all, repeat))
+    all_folds = reactor.fold_all_formulas(formulas)
+    prices = {it: ips(it) for it in hist}
+    for jobs in sorted({1, os.cpu_count() or 1}):
+        timings.append(
+            measure(
+                f"price_formulas_jobs_{jobs}",
+                lambda: reactor.price_formulas(prices, all_folds, jobs),
+                repeat,
+            )
+        )
+    timings.append(
+        measure(
+            "fold_search",
+            lambda: [
+                reactor.FoldSearch(
+                    {f.output.item_type.id: f for f in formulas}, ips
+                ).best_folds(f)
+                for f in formulas
+            ],
+            repeat,
+        )
+    )
+
+    def history_pipeline():
+        pm = reactor.build_price_matrix(hist, dates)
+        cf = reactor.compile_formulas(folds, pm.items)
+        reactor.backtest_formulas(pm, cf)
+
+    timings.append(measure("history", history_pipeline, repeat))
+
+    rng = random.Random(shape.seed)
+    buy_orders = synthetic.make_orders(rng, 1, ORDER_BOOK_SIZE, True)
+    sell_orders = synthetic.make_orders(rng, 1, ORDER_BOOK_SIZE, False)
+    timings.append(
+        measure(
+            "buy_order_price",
+            lambda: market.buy_order_price(buy_orders),
+            repeat,
+        )
+    )
+    timings.append(
+        measure(
+            "sell_order_price",
+            lambda: market.sell_order_price(sell_orders),
+            repeat,
+        )
+    )
+    raw_histories = [
+        synthetic.make_history(rng, shape.days, datetime.date.today())
+        for _ in universe.traded_ids
+    ]
+    timings.append(
+        measure(
+            "parse_history",
+            lambda: [market.parse_history(h) for h in raw_histories],
+            repeat,
+        )
+    )
+    return timings
+
+
+def compare(timings: List[Timing], baseline: Dict[str, Any]) -> List[str]:
+    """Names of benchmarks that got slower than the baseline allows."""
+    before = {t["name"]: t["min"] for t in baseline["timings"]}
+    regressions = []
+    for t in timings:
+        if t.name not in before:
+            continue
+        ratio = t.min / before[t.name]
+        print(
+            f"{t.name:28} {before[t.name]:10.4f}s -> {t.min:10.4f}s "
+            f"{ratio:6.2f}x"
+        )
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(t.name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    defaults = synthetic.Shape()
+    for field in dataclasses.fields(synthetic.Shape):
+        parser.add_argument(
+            f"--{field.name.replace('_', '-')}",
+            type=int,
+            default=getattr(defaults, field.name),
+        )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--data-dir", help="keep generated DBs here")
+    parser.add_argument("--save", help="write results as JSON here")
+    parser.add_argument(
+        "--baseline", help="compare against results saved with --save"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    shape = synthetic.Shape(
+        **{
+            f.name: getattr(args, f.name)
+            for f in dataclasses.fields(synthetic.Shape)
+        }
+    )
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+        timings = run_benchmarks(args.data_dir, shape, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            timings = run_benchmarks(data_dir, shape, args.repeat)
+    results = {
+        "shape": dataclasses.asdict(shape),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "timings": [dataclasses.asdict(t) for t in timings],
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["shape"] != results["shape"]:
+            logging.warning("baseline was taken with a different shape")
+        regressions = compare(timings, baseline)
+        if regressions:
+            print("slower than baseline: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+import dataclasses
+import datetime
+import random
+import sqlite3
+from typing import Any, Dict, List
+
+from eve import db, market, world
+
+MATERIAL_CATEGORY_ID = 4
+BLUEPRINT_CATEGORY_ID = 9
+RAW_GROUP_ID = 1
+PRODUCT_GROUP_ID = 2
+FORMULA_GROUP_ID = 3
+# Far above real type ids so synthetic items can't be mistaken for them.
+FIRST_TYPE_ID = 1_000_000
+
+
+@dataclasses.dataclass(frozen=True)
+class Shape:
+    # Items that are only ever bought.
+    raw_items: int = 200
+    # Formulas per tier; tier N consumes the outputs of tier N - 1.
+    formulas: int = 100
+    depth: int = 3
+    inputs: int = 4
+    days: int = 365
+    seed: int = 0
+
+
+@dataclasses.dataclass(frozen=True)
+class Universe:
+    raw_ids: List[int]
+    # Blueprint ids, lowest tier first.
+    blueprint_ids: List[int]
+    product_ids: List[int]
+
+    @property
+    def traded_ids(self) -> List[int]:
+        return self.raw_ids + self.product_ids
+
+
+def create_reference_db(path: str, shape: Shape) -> Universe:
+    """Writes the SDE tables World reads, filled with a reaction tree."""
+    rng = random.Random(shape.seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE invCategories (categoryID INTEGER, categoryName TEXT);
+        CREATE TABLE invGroups (
+            groupID INTEGER, groupName TEXT, categoryID INTEGER
+        );
+        CREATE TABLE invTypes (
+            typeID INTEGER PRIMARY KEY, typeName TEXT, groupID INTEGER,
+            volume REAL
+        );
+        CREATE INDEX ix_invTypes_typeName ON invTypes (typeName);
+        CREATE TABLE staStations (
+            stationID INTEGER PRIMARY KEY, stationName TEXT, security REAL
+        );
+        CREATE TABLE industryActivity (
+            typeID INTEGER, activityID INTEGER, time INTEGER
+        );
+        CREATE TABLE industryActivityMaterials (
+            typeID INTEGER, activityID INTEGER, materialTypeID INTEGER,
+            quantity INTEGER
+        );
+        CREATE TABLE industryActivityProducts (
+            typeID INTEGER, activityID INTEGER, productTypeID INTEGER,
+            quantity INTEGER
+        );
+        CREATE INDEX ix_industryActivity_typeID
+            ON industryActivity (typeID);
+        CREATE INDEX ix_industryActivityMaterials_typeID
+            ON industryActivityMaterials (typeID);
+        CREATE INDEX ix_industryActivityMaterials_materialTypeID
+            ON industryActivityMaterials (materialTypeID);
+        CREATE INDEX ix_industryActivityProducts_typeID
+            ON industryActivityProducts (typeID);
+        CREATE INDEX ix_industryActivityProducts_productTypeID
+            ON industryActivityProducts (productTypeID);
+        """
+    )
+    conn.executemany(
+        "INSERT INTO invCategories VALUES (?, ?)",
+        [
+            (MATERIAL_CATEGORY_ID, "Material"),
+            (BLUEPRINT_CATEGORY_ID, "Blueprint"),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO invGroups VALUES (?, ?, ?)",
+        [
+            (RAW_GROUP_ID, "Moon Materials", MATERIAL_CATEGORY_ID),
+            (PRODUCT_GROUP_ID, "Composite", MATERIAL_CATEGORY_ID),
+            (
+                FORMULA_GROUP_ID,
+                "Composite Reaction Formulas",
+                BLUEPRINT_CATEGORY_ID,
+            ),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO staStations VALUES (?, ?, ?)",
+        (world.JITA_4_4_STATION_ID, "Jita IV - Moon 4", 0.9),
+    )
+    next_id = iter(range(FIRST_TYPE_ID, FIRST_TYPE_ID * 2))
+    types = []
+    raw_ids = []
+    for i in range(shape.raw_items):
+        type_id = next(next_id)
+        raw_ids.append(type_id)
+        types.append((type_id, f"Raw {i}", RAW_GROUP_ID, rng.uniform(0.1, 5)))
+    blueprint_ids = []
+    product_ids = []
+    activities = []
+    materials = []
+    products = []
+    previous_tier = raw_ids
+    for tier in range(1, shape.depth + 1):
+        tier_ids = []
+        for i in range(shape.formulas):
+            product_id, blueprint_id = next(next_id), next(next_id)
+            name = f"Tier {tier} Product {i}"
+            types.append(
+                (product_id, name, PRODUCT_GROUP_ID, rng.uniform(0.1, 5))
+            )
+            types.append(
+                (blueprint_id, f"{name} Formula", FORMULA_GROUP_ID, 0.01)
+            )
+            activity = world.INDUSTRY_ACTIVITY_REACTIONS
+            activities.append((blueprint_id, activity, 3600 * tier))
+            # Mostly the tier below, so the tree really is `depth` deep.
+            pool = previous_tier if rng.random() < 0.8 else raw_ids
+            for material_id in rng.sample(pool, min(shape.inputs, len(pool))):
+                materials.append(
+                    (blueprint_id, activity, material_id, rng.randint(1, 200))
+                )
+            products.append(
+                (blueprint_id, activity, product_id, rng.randint(1, 200))
+            )
+            blueprint_ids.append(blueprint_id)
+            tier_ids.append(product_id)
+        product_ids.extend(tier_ids)
+        previous_tier = tier_ids
+    conn.executemany("INSERT INTO invTypes VALUES (?, ?, ?, ?)", types)
+    conn.executemany(
+        "INSERT INTO industryActivity VALUES (?, ?, ?)", activities
+    )
+    conn.executemany(
+        "INSERT INTO industryActivityMaterials VALUES (?, ?, ?, ?)",
+        materials,
+    )
+    conn.executemany(
+        "INSERT INTO industryActivityProducts VALUES (?, ?, ?, ?)", products
+    )
+    conn.commit()
+    conn.close()
+    return Universe(raw_ids, blueprint_ids, product_ids)
+
+
+def make_history(
+    rng: random.Random, days: int, end: datetime.date
+) -> List[Dict[str, Any]]:
+    """A random walk shaped like what ESI returns for one item."""
+    price = rng.uniform(10, 100_000)
+    history = []
+    for i in range(days):
+        price *= rng.uniform(0.97, 1.03)
+        history.append(
+            {
+                "date": end - datetime.timedelta(days=days - 1 - i),
+                "average": price,
+                "lowest": price * 0.98,
+                "highest": price * 1.02,
+                "volume": rng.randint(1, 1_000_000),
+                "order_count": rng.randint(1, 500),
+            }
+        )
+    return history
+
+
+def make_orders(
+    rng: random.Random, type_id: int, n: int, is_buy_order: bool
+) -> List[Dict[str, Any]]:
+    mid = rng.uniform(10, 100_000)
+    return [
+        {
+            "order_id": i,
+            "type_id": type_id,
+            "is_buy_order": is_buy_order,
+            "location_id": world.JITA_4_4_STATION_ID
+            if rng.random() < 0.7
+            else world.JITA_4_4_STATION_ID + rng.randint(1, 50),
+            "price": mid * rng.uniform(0.5, 1.0)
+            if is_buy_order
+            else mid * rng.uniform(1.0, 1.5),
+            "volume_remain": rng.randint(1, 10_000),
+        }
+        for i in range(n)
+    ]
+
+
+def create_store_db(path: str, universe: Universe, shape: Shape):
+    """Fills a store with `days` of history for every traded item."""
+    rng = random.Random(shape.seed)
+    end = datetime.date.today()
+    store = db.ConnectionPool(path)
+    with store.writer() as conn:
+        market.create_tables(conn)
+        with conn:
+            for type_id in universe.traded_ids:
+                market.store_history(
+                    conn, type_id, make_history(rng, shape.days, end)
+                )
@@ -0,0 +1,88 @@
+import collections
+import dataclasses
+from typing import Dict, Optional, Set
+
+from eve import world
+
+
+@dataclasses.dataclass(frozen=True)
+class Bill:
+    # Quantities per unit of the item the bill is for.
+    materials: Dict[world.ItemType, float]
+    intermediates: Dict[world.ItemType, float]
+
+
+class BillOfMaterials:
+    # Explodes items into raw materials through every manufacturing and
+    # reaction step. Formulas and sub-assembly bills are cached, so items
+    # sharing components resolve them once across all queries.
+    def __init__(self, w: world.World):
+        self.w = w
+        self._formulas: Dict[int, Optional[world.Formula]] = {}
+        self._bills: Dict[int, Bill] = {}
+        self._in_progress: Set[int] = set()
+        # Cycle cuts so far. A bill built while this went up depends on
+        # which item the query started from, so it isn't cached.
+        self._cuts = 0
+
+    def find_formula(self, it: world.ItemType) -> Optional[world.Formula]:
+        if it.id not in self._formulas:
+            f = None
+            bp = self.w.find_blueprint(it)
+            if bp is not None:
+                try:
+                    f = self.w.find_formula(bp)
+                except world.FormulaNotFound:
+                    pass
+            self._formulas[it.id] = f
+        return self._formulas[it.id]
+
+    def explode(self, it: world.ItemType) -> Bill:
+        if it.id in self._bills:
+            return self._bills[it.id]
+        f = self.find_formula(it)
+        if f is None:
+            bill = Bill({it: 1.0}, {})
+            self._bills[it.id] = bill
+            return bill
+        if it.id in self._in_progress:
+            # (Indirectly) an input of itself, so bought here.
+            self._cuts += 1
+            return Bill({it: 1.0}, {})
+        cuts = self._cuts
+        self._in_progress.add(it.id)
+        bill = self._explode_inputs(f, 1.0 / f.output.quantity)
+        self._in_progress.discard(it.id)
+        if self._cuts == cuts:
+            self._bills[it.id] = bill
+        return bill
+
+    def _explode_inputs(self, f: world.Formula, runs: float) -> Bill:
+        materials: Dict[world.ItemType, float] = collections.defaultdict(float)
+        intermediates: Dict[world.ItemType, float] = collections.defaultdict(
+            float
+        )
+        for inp in f.inputs:
+            qty = inp.quantity * runs
+            sub = self.explode(inp.item_type)
+            if inp.item_type not in sub.materials:
+                intermediates[inp.item_type] += qty
+            for it, sub_qty in sub.materials.items():
+                materials[it] += sub_qty * qty
+            for it, sub_qty in sub.intermediates.items():
+                intermediates[it] += sub_qty * qty
+        return Bill(dict(materials), dict(intermediates))
+
+    def explode_formula(self, f: world.Formula) -> world.Formula:
+        bill = self._explode_inputs(f, 1.0)
+        return world.Formula(
+            f.blueprint,
+            f.time,
+            f.output,
+            [world.ItemQuantity(it, q) for it, q in bill.materials.items()],
+            f.probability,
+            [
+                world.ItemQuantity(it, q)
+                for it, q in bill.intermediates.items()
+            ],
+        )
@@ -0,0 +1,116 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import urllib.parse
+from typing import Any, Callable, Dict, Iterator, Type
+
+from eve import instrument
+
+# The store is written by the refresher while reports read it, so it runs
+# in WAL mode where readers never block on the writer.
+STORE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+BUSY_TIMEOUT_SECONDS = 30.0
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Records a span per statement, used only while profiling.
+
+    Spans end once SQLite has produced the first row; fetching the rest
+    is counted against whatever span the caller is in.
+    """
+
+    def execute(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        with instrument.span("sql " + sql.split(None, 1)[0], sql=sql):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        with instrument.span("sql " + sql.split(None, 1)[0], sql=sql):
+            return super().executemany(sql, *args)
+
+
+def _connection_factory() -> Type[sqlite3.Connection]:
+    if instrument.enabled():
+        return InstrumentedConnection
+    return sqlite3.Connection
+
+
+def connect_store(path: str, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_SECONDS,
+        factory=_connection_factory(),
+        **kwargs,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in STORE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def connect_reference(path: str) -> sqlite3.Connection:
+    # The SDE never changes under us, so SQLite can skip locking entirely.
+    uri = f"file:{urllib.parse.quote(path)}?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, factory=_connection_factory())
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class ConnectionPool:
+    """Per-thread read connections and one writer shared under a lock."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer = connect_store(path, check_same_thread=False)
+
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_store(self.path)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        # Callers still open their own "with conn:" transactions; the lock
+        # only keeps threads from interleaving statements on the writer.
+        with self._write_lock:
+            yield self._writer
+
+
+def rebuild_with_key_columns(
+    conn: sqlite3.Connection,
+    table: str,
+    create_tables: Callable[[sqlite3.Connection], None],
+    values: Dict[str, Any],
+):
+    """Rebuilds a table whose schema gained columns in its primary key.
+
+    SQLite can't change a primary key in place, so the old table is
+    renamed, create_tables() makes the new one and the rows are copied
+    over with the missing columns set from `values`.
+    """
+    old_columns = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    missing = {k: v for k, v in values.items() if k not in old_columns}
+    if not missing:
+        return
+    logging.info("adding %s to the key of %s", ", ".join(missing), table)
+    columns = ", ".join(f'"{c}"' for c in [*old_columns, *missing])
+    placeholders = ", ".join("?" for _ in missing)
+    with conn:
+        conn.execute(f"ALTER TABLE {table} RENAME TO {table}Old")
+        create_tables(conn)
+        conn.execute(
+            f"INSERT OR IGNORE INTO {table}({columns}) "
+            f"SELECT *, {placeholders} FROM {table}Old",
+            list(missing.values()),
+        )
+        conn.execute(f"DROP TABLE {table}Old")
@@ -0,0 +1,145 @@
+import dataclasses
+import datetime
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from eve import db, esi_scheduler, market, world
+
+# Recorded and replayed prices are kept in a store next to the archive so
+# they never get mixed up with live ones. Anything fresh in it has been
+# recorded, so recording only has to fetch what the store considers stale.
+ARCHIVE_STORE_FILE_NAME = "store.sqlite"
+
+
+def open_store(archive: str) -> db.ConnectionPool:
+    os.makedirs(archive, exist_ok=True)
+    store = db.ConnectionPool(os.path.join(archive, ARCHIVE_STORE_FILE_NAME))
+    with store.writer() as conn:
+        market.create_tables(conn)
+    return store
+
+
+def _response_path(archive: str, region_id: int, type_id: int) -> str:
+    return os.path.join(archive, str(region_id), f"{type_id}.json")
+
+
+def _encode_value(v: Any) -> Any:
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        return v.isoformat()
+    raise TypeError(f"can't archive {type(v).__name__}")
+
+
+def _decode_history(result: List[Any]) -> List[Any]:
+    for day in result:
+        day["date"] = datetime.date.fromisoformat(day["date"])
+    return result
+
+
+def _decode_orders(result: List[Any]) -> List[Any]:
+    # Orders taken from a region snapshot carry no issue date.
+    for order in result:
+        if isinstance(order.get("issued"), str):
+            order["issued"] = datetime.datetime.fromisoformat(order["issued"])
+    return result
+
+
+def _decode_response(
+    data: Dict[str, Any], decode_result: Callable[[List[Any]], List[Any]]
+) -> market.EsiResponse:
+    def parse(value: Optional[str]) -> Optional[datetime.datetime]:
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    result = data["result"]
+    return market.EsiResponse(
+        None if result is None else decode_result(result),
+        parse(data["expires"]),
+        parse(data["last_modified"]),
+        data["etag"],
+        data["pages"],
+    )
+
+
+def write_responses(archive: str, responses: market.MarketResponses):
+    path = _response_path(archive, responses.region_id, responses.type_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dataclasses.asdict(responses), f, default=_encode_value)
+    os.replace(tmp_path, path)
+
+
+def read_responses(
+    archive: str, region_id: int, type_id: int
+) -> Optional[market.MarketResponses]:
+    try:
+        with open(_response_path(archive, region_id, type_id)) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    return market.MarketResponses(
+        type_id,
+        datetime.datetime.fromisoformat(data["retrieved_on"]),
+        _decode_response(data["history"], _decode_history),
+        _decode_response(data["buy_orders"], _decode_orders),
+        _decode_response(data["sell_orders"], _decode_orders),
+        region_id,
+    )
+
+
+class RecordingFetcher(market.MarketFetcher):
+    """Saves everything another fetcher returns to an archive directory.
+
+    Stored ETags are dropped from the requests so ESI always sends full
+    bodies; a 304 would leave nothing to replay.
+    """
+
+    def __init__(self, fetcher: market.MarketFetcher, archive: str):
+        self.fetcher = fetcher
+        self.archive = archive
+
+    def fetch_many(
+        self,
+        requests: List[market.FetchRequest],
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: int = world.JITA_REGION_ID,
+    ) -> Iterator[market.MarketResponses]:
+        requests = [(type_id, None, orders) for type_id, _, orders in requests]
+        for responses in self.fetcher.fetch_many(
+            requests, priority, region_id
+        ):
+            write_responses(self.archive, responses)
+            yield responses
+
+
+class ReplayFetcher(market.MarketFetcher):
+    """Serves responses saved by RecordingFetcher without touching ESI."""
+
+    def __init__(self, archive: str):
+        self.archive = archive
+
+    def fetch_many(
+        self,
+        requests: List[market.FetchRequest],
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: int = world.JITA_REGION_ID,
+    ) -> Iterator[market.MarketResponses]:
+        for type_id, _, _ in requests:
+            responses = read_responses(self.archive, region_id, type_id)
+            if responses is None:
+                logging.warning(
+                    "type %d in region %d was never recorded",
+                    type_id,
+                    region_id,
+                )
+                empty = market.EsiResponse([])
+                responses = market.MarketResponses(
+                    type_id,
+                    datetime.datetime.fromtimestamp(0),
+                    empty,
+                    empty,
+                    empty,
+                    region_id,
+                )
+            yield responses
@@ -0,0 +1,238 @@
+import asyncio
+import datetime
+import json
+import logging
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+
+from eve import esi_scheduler, instrument, market, world
+
+if TYPE_CHECKING:
+    import aiohttp
+
+ESI_BASE_URL = "https://esi.evetech.net/latest"
+DEFAULT_CONCURRENCY = 32
+
+
+@instrument.timed("parse_history")
+def _parse_history(result: List[Any]) -> List[Any]:
+    # Match what bravado unmarshals so stored rows do not depend on backend.
+    for day in result:
+        day["date"] = datetime.date.fromisoformat(day["date"])
+    return result
+
+
+@instrument.timed("parse_orders")
+def _parse_orders(result: List[Any]) -> List[Any]:
+    for order in result:
+        order["issued"] = datetime.datetime.fromisoformat(
+            order["issued"].replace("Z", "+00:00")
+        )
+    return result
+
+
+class AsyncEsiClient:
+    """Coroutine versions of the ESI market calls over one HTTP session.
+
+    The session keeps connections alive between requests, and at most
+    `concurrency` requests are in flight at any time.
+    """
+
+    def __init__(
+        self,
+        base_url: str = ESI_BASE_URL,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        region_id: int = world.JITA_REGION_ID,
+        scheduler: esi_scheduler.EsiScheduler = (
+            esi_scheduler.default_scheduler
+        ),
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.region_id = region_id
+        self.scheduler = scheduler
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "AsyncEsiClient":
+        import aiohttp
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            raise_for_status=False,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info: Any):
+        assert self._session
+        await self._session.close()
+        self._session = None
+
+    async def _get(
+        self,
+        route: str,
+        path: str,
+        etag: Optional[str],
+        priority: int,
+        **params: Any,
+    ) -> market.EsiResponse:
+        assert self._session and self._semaphore
+        headers = {"If-None-Match": etag} if etag else {}
+        params = {"datasource": "tranquility", **params}
+        attempt = 0
+        while True:
+            with instrument.span("esi wait"):
+                await self.scheduler.acquire_async(route, priority)
+            async with self._semaphore:
+                with instrument.span(f"esi {route}"):
+                    async with self._session.get(
+                        self.base_url + path, params=params, headers=headers
+                    ) as response:
+                        body = await response.read()
+                self.scheduler.record(response.status, response.headers)
+                instrument.count("esi bytes", len(body))
+                if response.status == 404:
+                    return market.EsiResponse([])
+                if response.status == 304:
+                    return market.esi_response_from_headers(
+                        None, response.headers
+                    )
+                if response.status < 400:
+                    with instrument.span("json"):
+                        result = json.loads(body)
+                    return market.esi_response_from_headers(
+                        result, response.headers
+                    )
+                delay = esi_scheduler.retry_delay(response.status, attempt)
+                if delay is None:
+                    response.raise_for_status()
+            logging.warning(
+                "%s failed with %d, retrying", route, response.status
+            )
+            await asyncio.sleep(delay or 0.0)
+            attempt += 1
+
+    async def get_market_history(
+        self,
+        type_id: int,
+        etag: Optional[str] = None,
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: Optional[int] = None,
+    ) -> market.EsiResponse:
+        response = await self._get(
+            "get_markets_region_id_history",
+            f"/markets/{region_id or self.region_id}/history/",
+            etag,
+            priority,
+            type_id=type_id,
+        )
+        if response.result:
+            _parse_history(response.result)
+        return response
+
+    async def get_market_orders(
+        self,
+        type_id: int,
+        order_type: str,
+        etag: Optional[str] = None,
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: Optional[int] = None,
+    ) -> market.EsiResponse:
+        route = "get_markets_region_id_orders"
+        path = f"/markets/{region_id or self.region_id}/orders/"
+        response = await self._get(
+            route, path, etag, priority, type_id=type_id, order_type=order_type
+        )
+        if response.result is not None and response.pages > 1:
+            # The ETag only covers the first page, the rest always come
+            # with a body.
+            pages = await asyncio.gather(
+                *(
+                    self._get(
+                        route,
+                        path,
+                        None,
+                        priority,
+                        type_id=type_id,
+                        order_type=order_type,
+                        page=page,
+                    )
+                    for page in range(2, response.pages + 1)
+                )
+            )
+            for page in pages:
+                response.result.extend(page.result or [])
+        if response.result:
+            _parse_orders(response.result)
+        return response
+
+    async def fetch_market_data(
+        self,
+        type_id: int,
+        etags: Optional[Dict[str, str]] = None,
+        orders: Optional[market.MarketOrders] = None,
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: Optional[int] = None,
+    ) -> market.MarketResponses:
+        etags = etags or {}
+        region_id = region_id or self.region_id
+        history_call = self.get_market_history(
+            type_id, etags.get("history"), priority, region_id
+        )
+        if orders is None:
+            history, buy_orders, sell_orders = await asyncio.gather(
+                history_call,
+                self.get_market_orders(
+                    type_id, "buy", etags.get("buy"), priority, region_id
+                ),
+                self.get_market_orders(
+                    type_id, "sell", etags.get("sell"), priority, region_id
+                ),
+            )
+        else:
+            history = await history_call
+            buy_orders = market.EsiResponse(orders[0])
+            sell_orders = market.EsiResponse(orders[1])
+        return market.MarketResponses(
+            type_id,
+            datetime.datetime.now(),
+            history,
+            buy_orders,
+            sell_orders,
+            region_id,
+        )
+
+
+class AsyncFetcher(market.MarketFetcher):
+    """Fetches a batch of items on an event loop instead of threads."""
+
+    def __init__(
+        self,
+        base_url: str = ESI_BASE_URL,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.base_url = base_url
+        self.concurrency = concurrency
+
+    async def _fetch_all(
+        self,
+        requests: List[market.FetchRequest],
+        priority: int,
+        region_id: int,
+    ) -> List[market.MarketResponses]:
+        async with AsyncEsiClient(
+            self.base_url, self.concurrency, region_id
+        ) as client:
+            return await asyncio.gather(
+                *(client.fetch_market_data(*r, priority) for r in requests)
+            )
+
+    def fetch_many(
+        self,
+        requests: List[market.FetchRequest],
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: int = world.JITA_REGION_ID,
+    ) -> Iterator[market.MarketResponses]:
+        return iter(
+            asyncio.run(self._fetch_all(requests, priority, region_id))
+        )
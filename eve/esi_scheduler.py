@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from eve import db
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Requests per second and burst size, per ESI route.
+DEFAULT_ROUTE_RATE = (20.0, 40)
+ROUTE_RATES: Dict[str, Tuple[float, int]] = {
+    "get_markets_region_id_history": (10.0, 20),
+}
+
+# ESI bans the IP once the error budget for the window is spent. Below
+# ERROR_LIMIT_SLOWDOWN the remaining budget is spread over the window,
+# below ERROR_LIMIT_FLOOR nothing is sent until the window resets.
+ERROR_LIMIT_SLOWDOWN = 50
+ERROR_LIMIT_FLOOR = 10
+
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+RETRYABLE_STATUSES = {420, 502, 503, 504}
+
+BACKGROUND_POLL_INTERVAL = 0.05
+
+# Processes sharing a store also share the error budget, which ESI keeps
+# per IP, and background requests yield to interactive ones in any of
+# them. They catch up with each other through the store at most this
+# often.
+SHARED_SYNC_INTERVAL = 1.0
+# How long background requests stay paused after an interactive request.
+INTERACTIVE_HOLD = 10.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class EsiScheduler:
+    """Paces ESI requests per route and against the shared error budget.
+
+    Interactive requests always get the next free slot, queueing on the
+    route's bucket if they have to. Background requests only go out when
+    no interactive request is waiting and a token is free right now.
+    Once share() is called, the error budget and interactive activity are
+    also exchanged with other processes using the same store, so a
+    background refresher stays out of the way of interactive commands.
+    Route buckets stay per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._pace = 0.0
+        self._next_paced = 0.0
+        self._interactive_waiting = 0
+        self.error_limit_remain: Optional[int] = None
+        self._store: Optional[db.ConnectionPool] = None
+        self._synced = -SHARED_SYNC_INTERVAL
+        self._interactive_since_sync = False
+        # Wall clock time until which another process is interactive.
+        self._shared_interactive_until = 0.0
+
+    def share(self, store: db.ConnectionPool):
+        with store.writer() as conn:
+            create_tables(conn)
+        with self._lock:
+            self._store = store
+
+    def _bucket(self, route: str) -> TokenBucket:
+        if route not in self._buckets:
+            rate, burst = ROUTE_RATES.get(route, DEFAULT_ROUTE_RATE)
+            self._buckets[route] = TokenBucket(rate, burst)
+        return self._buckets[route]
+
+    def _sync(self):
+        """Swaps state with other processes through the store.
+
+        The store is only touched outside the lock, so a process holding
+        the store's write lock stalls the syncing thread, not every
+        request. A sync that fails is retried on the next interval.
+        """
+        with self._lock:
+            store = self._store
+            publish = self._interactive_since_sync
+            self._interactive_since_sync = False
+        assert store is not None
+        try:
+            if publish:
+                with store.writer() as conn:
+                    with conn:
+                        conn.execute(
+                            "UPDATE eveEsiBudget SET interactive_until = "
+                            "max(interactive_until, ?) WHERE id = 0",
+                            (time.time() + INTERACTIVE_HOLD,),
+                        )
+            remain, reset_at, interactive_until = _read_budget(store.reader())
+        except sqlite3.OperationalError as e:
+            logging.warning("can't share the ESI budget: %s", e)
+            with self._lock:
+                self._interactive_since_sync |= publish
+            return
+        with self._lock:
+            self._shared_interactive_until = interactive_until
+            wall = time.time()
+            if remain is not None and reset_at > wall:
+                self._apply_error_limit(
+                    0, remain, reset_at - wall, time.monotonic()
+                )
+
+    def _sync_due(self, priority: int) -> bool:
+        """Whether the caller should _sync() before taking a slot."""
+        with self._lock:
+            now = time.monotonic()
+            if priority == INTERACTIVE:
+                self._interactive_since_sync = True
+            if (
+                self._store is None
+                or now - self._synced < SHARED_SYNC_INTERVAL
+            ):
+                return False
+            # One caller syncs while the others go on with what they have.
+            self._synced = now
+            return True
+
+    def _schedule(self, route: str, priority: int) -> Tuple[bool, float]:
+        """Returns whether a slot was taken and how long to sleep."""
+        if self._sync_due(priority):
+            self._sync()
+        return self._take(route, priority)
+
+    def _take(self, route: str, priority: int) -> Tuple[bool, float]:
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(route)
+            bucket.refill(now)
+            wait = max(
+                self._paused_until - now,
+                self._next_paced - now,
+                bucket.wait_time(),
+            )
+            if priority != INTERACTIVE and (
+                wait > 0
+                or self._interactive_waiting
+                or time.time() < self._shared_interactive_until
+            ):
+                return False, max(wait, BACKGROUND_POLL_INTERVAL)
+            bucket.tokens -= 1
+            if self._pace:
+                self._next_paced = max(now, self._next_paced) + self._pace
+            return True, wait
+
+    def acquire(self, route: str, priority: int = INTERACTIVE):
+        if priority == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting += 1
+        try:
+            while True:
+                taken, wait = self._schedule(route, priority)
+                if wait > 0:
+                    time.sleep(wait)
+                if taken:
+                    return
+        finally:
+            if priority == INTERACTIVE:
+                with self._lock:
+                    self._interactive_waiting -= 1
+
+    async def acquire_async(self, route: str, priority: int = INTERACTIVE):
+        if priority == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting += 1
+        try:
+            while True:
+                if self._sync_due(priority):
+                    # Off the event loop, which a busy store would stall.
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self._sync
+                    )
+                taken, wait = self._take(route, priority)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if taken:
+                    return
+        finally:
+            if priority == INTERACTIVE:
+                with self._lock:
+                    self._interactive_waiting -= 1
+
+    def record(self, status: int, headers: Mapping[str, Any]):
+        remain = headers.get("X-ESI-Error-Limit-Remain")
+        reset = headers.get("X-ESI-Error-Limit-Reset")
+        if remain is None or reset is None:
+            return
+        remain, reset = int(remain), int(reset)
+        with self._lock:
+            self._apply_error_limit(status, remain, reset, time.monotonic())
+            store = self._store
+        # Other processes only need to hear about a budget running low.
+        if store is None or (status != 420 and remain >= ERROR_LIMIT_SLOWDOWN):
+            return
+        try:
+            with store.writer() as conn:
+                with conn:
+                    conn.execute(
+                        "UPDATE eveEsiBudget SET error_limit_remain = ?, "
+                        "error_limit_reset_at = ? WHERE id = 0",
+                        (remain, time.time() + reset),
+                    )
+        except sqlite3.OperationalError as e:
+            logging.warning("can't share the ESI budget: %s", e)
+
+    def _apply_error_limit(
+        self, status: int, remain: int, reset: float, now: float
+    ):
+        self.error_limit_remain = remain
+        if status == 420 or remain <= ERROR_LIMIT_FLOOR:
+            if self._paused_until < now + reset:
+                logging.warning(
+                    "ESI error budget at %d, pausing for %ds", remain, reset
+                )
+            self._paused_until = max(self._paused_until, now + reset)
+        elif remain < ERROR_LIMIT_SLOWDOWN:
+            self._pace = reset / (remain - ERROR_LIMIT_FLOOR)
+        else:
+            self._pace = 0.0
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveEsiBudget" (
+            "id" INTEGER PRIMARY KEY NOT NULL CHECK ("id" = 0),
+            "error_limit_remain" INTEGER,
+            "error_limit_reset_at" REAL NOT NULL,
+            "interactive_until" REAL NOT NULL
+        );
+        """)
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO eveEsiBudget VALUES (0, NULL, 0, 0)"
+        )
+
+
+def _read_budget(
+    conn: sqlite3.Connection,
+) -> Tuple[Optional[int], float, float]:
+    row = conn.execute(
+        "SELECT error_limit_remain, error_limit_reset_at, interactive_until "
+        "FROM eveEsiBudget WHERE id = 0"
+    ).fetchone()
+    return tuple(row) if row else (None, 0.0, 0.0)
+
+
+def retry_delay(status: int, attempt: int) -> Optional[float]:
+    """How long to wait before retrying a failed request, None to give up."""
+    if status not in RETRYABLE_STATUSES or attempt + 1 >= RETRY_ATTEMPTS:
+        return None
+    # A 420 pauses the scheduler itself, so only server errors sleep here.
+    return 0.0 if status == 420 else RETRY_DELAY * 2 ** attempt
+
+
+default_scheduler = EsiScheduler()
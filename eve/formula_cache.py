@@ -0,0 +1,46 @@
+import logging
+import os
+import pickle
+from typing import Callable, Hashable, TypeVar
+
+from eve import instrument
+
+COMPILED_DIR = "../data/compiled"
+# Bump when the layout of cached objects changes.
+FORMAT_VERSION = 2
+
+T = TypeVar("T")
+
+
+def reference_db_key(path: str) -> Hashable:
+    # Size and mtime change whenever a new fuzzwork dump is unpacked, and
+    # are much cheaper than hashing a multi-hundred-megabyte file.
+    st = os.stat(path)
+    return (FORMAT_VERSION, st.st_size, st.st_mtime_ns)
+
+
+def _artifact_path(name: str) -> str:
+    return os.path.join(os.path.dirname(__file__), COMPILED_DIR, name)
+
+
+def load_or_build(name: str, key: Hashable, build: Callable[[], T]) -> T:
+    path = _artifact_path(name + ".pickle")
+    try:
+        with open(path, "rb") as f, instrument.span("compiled load"):
+            stored_key, value = pickle.load(f)
+        if stored_key == key:
+            return value
+        logging.info("compiled %s is out of date", name)
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        logging.warning("ignoring unreadable compiled %s", name)
+    logging.info("building compiled %s", name)
+    with instrument.span("compiled build"):
+        value = build()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return value
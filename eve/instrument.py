@@ -0,0 +1,179 @@
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Spans and counters are only recorded while a Recorder is installed.
+# Until then span() hands out one shared do-nothing context and count()
+# returns straight away, so instrumented code costs a global lookup.
+_recorder: Optional["Recorder"] = None
+_NO_SPAN = contextlib.nullcontext()
+
+# Name, start and end in seconds since the recorder started, thread, args.
+SpanEvent = Tuple[str, float, float, int, Dict[str, Any]]
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.events: List[SpanEvent] = []
+        self.counters: Dict[
+            str, collections.Counter
+        ] = collections.defaultdict(collections.Counter)
+
+    def now(self) -> float:
+        return time.perf_counter() - self._start
+
+    def add_span(
+        self, name: str, start: float, end: float, args: Dict[str, Any]
+    ):
+        event = (name, start, end, threading.get_ident(), args)
+        with self._lock:
+            self.events.append(event)
+
+    def add_count(self, name: str, key: str, n: int):
+        with self._lock:
+            self.counters[name][key] += n
+
+    def summary(self) -> Dict[str, Any]:
+        spans: Dict[str, Dict[str, float]] = {}
+        for name, start, end, _, _ in self.events:
+            s = spans.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            s["count"] += 1
+            s["total"] += end - start
+            s["max"] = max(s["max"], end - start)
+        return {
+            "wall_time": self.now(),
+            "spans": spans,
+            "counters": {
+                name: {"total": sum(c.values()), "by_key": dict(c)}
+                for name, c in self.counters.items()
+            },
+        }
+
+    def table(self) -> str:
+        summary = self.summary()
+        lines = [
+            f"{'span':40} {'calls':>8} {'total s':>10} "
+            f"{'mean ms':>10} {'max ms':>10}"
+        ]
+        spans = sorted(
+            summary["spans"].items(), key=lambda s: s[1]["total"], reverse=True
+        )
+        for name, s in spans:
+            lines.append(
+                f"{name:40} {s['count']:8d} {s['total']:10.3f} "
+                f"{1000 * s['total'] / s['count']:10.2f} "
+                f"{1000 * s['max']:10.2f}"
+            )
+        lines.append("")
+        lines.append(f"{'counter':40} {'total':>12} {'keys':>8}")
+        for name, c in sorted(summary["counters"].items()):
+            lines.append(f"{name:40} {c['total']:12,d} {len(c['by_key']):8d}")
+        lines.append("")
+        lines.append(f"wall time {summary['wall_time']:.3f}s")
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Events for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": name.split(" ")[0],
+                    "ph": "X",
+                    "ts": 1e6 * start,
+                    "dur": 1e6 * (end - start),
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+                for name, start, end, tid, args in self.events
+            ]
+        }
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "args", "start")
+
+    def __init__(self, recorder: Recorder, name: str, args: Dict[str, Any]):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.recorder.now()
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        self.recorder.add_span(
+            self.name, self.start, self.recorder.now(), self.args
+        )
+
+
+def span(name: str, **args: Any) -> contextlib.AbstractContextManager:
+    if _recorder is None:
+        return _NO_SPAN
+    return _Span(_recorder, name, args)
+
+
+def count(name: str, n: int = 1, key: str = ""):
+    if _recorder is not None:
+        _recorder.add_count(name, key, n)
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator recording a span around every call."""
+
+    def decorate(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with _Span(_recorder, name, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorate
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+def enable() -> Recorder:
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def disable() -> Optional[Recorder]:
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def write_report(recorder: Recorder, report_format: str, path: str):
+    """Writes a table, a JSON summary or a Chrome trace, "-" for stdout."""
+    if report_format == "table":
+        text = recorder.table() + "\n"
+    elif report_format == "json":
+        text = json.dumps(recorder.summary(), indent=2) + "\n"
+    elif report_format == "chrome":
+        text = json.dumps(recorder.chrome_trace())
+    else:
+        raise ValueError(f"unknown profile format '{report_format}'")
+    if path == "-":
+        print(text, end="")
+        return
+    with open(path, "w") as f:
+        f.write(text)
@@ -1,17 +1,40 @@
+import abc
+import collections.abc
+import concurrent.futures
 import dataclasses
 import datetime
+import email.utils
+import itertools
 import logging
+import os
 import math
-import random
 import sqlite3
 import json
-from typing import Any, Dict, List
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
-import bravado
-from bravado.client import SwaggerClient
+import numpy as np
 
-from eve import world
-from eve.orm_util import adopt_json_for_db, dataclass_from_row
+from eve import db, esi_scheduler, instrument, order_snapshots, world
+from eve.orm_util import (
+    adopt_value_for_db,
+    dataclass_from_row,
+    dataclasses_from_rows,
+)
+
+if TYPE_CHECKING:
+    from bravado.client import CallableOperation, SwaggerClient
 
 
 @dataclasses.dataclass(frozen=True)
@@ -32,6 +55,10 @@ class ItemPriceWithDetails:
     history: List[Any]
     buy_orders: List[Any]
     sell_orders: List[Any]
+    # The books the prices were read from.
+    buy_book: "OrderBook"
+    sell_book: "OrderBook"
+    location_id: int = world.JITA_4_4_STATION_ID
 
 
 @dataclasses.dataclass(frozen=True)
@@ -44,116 +71,651 @@ class HistoricalItemPrice:
     order_count: float
 
 
+class PriceSeries(collections.abc.Sequence):
+    """Daily history of one item as parallel arrays, oldest day first.
+
+    Indexing gives HistoricalItemPrice like the list it replaces, while
+    slices and between() are cheap views over the same arrays.
+    """
+
+    __slots__ = (
+        "dates",
+        "average",
+        "lowest",
+        "highest",
+        "volume",
+        "order_count",
+    )
+
+    def __init__(
+        self,
+        dates: np.ndarray,
+        average: np.ndarray,
+        lowest: np.ndarray,
+        highest: np.ndarray,
+        volume: np.ndarray,
+        order_count: np.ndarray,
+    ):
+        self.dates = dates  # datetime64[D]
+        self.average = average
+        self.lowest = lowest
+        self.highest = highest
+        self.volume = volume
+        self.order_count = order_count
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[Any, ...]]) -> "PriceSeries":
+        """Builds a series from (date, average, lowest, highest, volume,
+        order_count) tuples sorted by date."""
+        columns = list(zip(*rows)) or [()] * 6
+        return cls(
+            np.array(columns[0], dtype="datetime64[D]"),
+            *(np.array(c, dtype=float) for c in columns[1:]),
+        )
+
+    @classmethod
+    def from_days(cls, days: Iterable[HistoricalItemPrice]) -> "PriceSeries":
+        return cls.from_rows(
+            (d.date, d.average, d.lowest, d.highest, d.volume, d.order_count)
+            for d in days
+        )
+
+    def _arrays(self) -> List[np.ndarray]:
+        return [getattr(self, name) for name in self.__slots__]
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PriceSeries(*(a[i] for a in self._arrays()))
+        return HistoricalItemPrice(
+            self.dates[i].item(),
+            float(self.average[i]),
+            float(self.lowest[i]),
+            float(self.highest[i]),
+            float(self.volume[i]),
+            float(self.order_count[i]),
+        )
+
+    def __iter__(self) -> Iterator[HistoricalItemPrice]:
+        for row in zip(*(a.tolist() for a in self._arrays())):
+            yield HistoricalItemPrice(*row)
+
+    def __repr__(self) -> str:
+        return f"PriceSeries({list(self)!r})"
+
+    def date_list(self) -> List[datetime.date]:
+        return self.dates.tolist()
+
+    def between(
+        self,
+        start: Optional[datetime.date] = None,
+        end: Optional[datetime.date] = None,
+    ) -> "PriceSeries":
+        lo, hi = 0, len(self)
+        if start is not None:
+            lo = int(np.searchsorted(self.dates, np.datetime64(start, "D")))
+        if end is not None:
+            hi = int(
+                np.searchsorted(
+                    self.dates, np.datetime64(end, "D"), side="right"
+                )
+            )
+        return self[lo:hi]
+
+    def vwap(self) -> float:
+        return float(self.volume @ self.average) / float(self.volume.sum())
+
+    def mean(self, field: str = "average") -> float:
+        return float(getattr(self, field).mean())
+
+
 MIN_TOTAL_COST = 100000000
 MIN_TOTAL_QTY = 2
 BUY_ORDER_SETUP_DISCOUNT = 0.95
 SELL_ORDER_SETUP_DISCOUNT = 1.05
 
+PREFETCH_WORKERS = 8
 
-def buy_order_price(buy_orders: List[Dict[str, Any]]) -> float:
-    prices = [
-        (x["volume_remain"], x["price"])
-        for x in buy_orders
-        if x["is_buy_order"] and x["volume_remain"] > 0
-    ]
-    prices.sort(key=lambda p: p[1], reverse=True)
-    total_cost = 0.0
-    total_qty = 0.0
-    for p in prices:
-        total_cost += p[0] * p[1]
-        total_qty += p[0]
-        if total_cost >= MIN_TOTAL_COST and total_qty >= MIN_TOTAL_QTY:
-            return p[1]
-    return 0.0
-
-
-def is_good_sell_order(x: Dict[str, Any]) -> bool:
+# Prices are kept per region and location; ANY_LOCATION prices an item
+# from every sell order in the region rather than one station's.
+ANY_LOCATION = 0
+
+FRESHNESS_WINDOW = datetime.timedelta(hours=3)
+# How long past its announced next beat a refresher still counts as alive.
+REFRESHER_HEARTBEAT_GRACE = datetime.timedelta(minutes=2)
+
+
+def is_good_sell_order(
+    x: Dict[str, Any], location_id: int = world.JITA_4_4_STATION_ID
+) -> bool:
     return (
         (not x["is_buy_order"])
         and x["volume_remain"] > 0
-        and x["location_id"] == world.JITA_4_4_STATION_ID
+        and location_id in (ANY_LOCATION, x["location_id"])
+    )
+
+
+class OrderBook:
+    """One side of an item's market, best price first.
+
+    Running quantity and cost totals make fill queries a binary search
+    instead of a rescan of the orders.
+    """
+
+    def __init__(self, prices: np.ndarray, quantities: np.ndarray):
+        self.prices = prices
+        self.quantities = quantities
+        self.cum_qty = np.cumsum(quantities)
+        self.cum_cost = np.cumsum(prices * quantities)
+
+    @classmethod
+    def _from_orders(
+        cls, orders: List[Tuple[float, float]], descending: bool
+    ) -> "OrderBook":
+        quantities = np.array([o[0] for o in orders], dtype=float)
+        prices = np.array([o[1] for o in orders], dtype=float)
+        order = np.argsort(-prices if descending else prices, kind="stable")
+        return cls(prices[order], quantities[order])
+
+    @classmethod
+    def buy_side(cls, buy_orders: List[Dict[str, Any]]) -> "OrderBook":
+        return cls._from_orders(
+            [
+                (x["volume_remain"], x["price"])
+                for x in buy_orders
+                if x["is_buy_order"] and x["volume_remain"] > 0
+            ],
+            descending=True,
+        )
+
+    @classmethod
+    def sell_side(
+        cls,
+        sell_orders: List[Dict[str, Any]],
+        location_id: int = world.JITA_4_4_STATION_ID,
+    ) -> "OrderBook":
+        return cls._from_orders(
+            [
+                (x["volume_remain"], x["price"])
+                for x in sell_orders
+                if is_good_sell_order(x, location_id)
+            ],
+            descending=False,
+        )
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    @property
+    def depth(self) -> float:
+        return float(self.cum_qty[-1]) if len(self) else 0.0
+
+    def threshold_price(
+        self, min_cost: float, min_qty: float, default: float
+    ) -> float:
+        """Price of the first order at which both totals are reached."""
+        i = max(
+            np.searchsorted(self.cum_cost, min_cost),
+            np.searchsorted(self.cum_qty, min_qty),
+        )
+        return float(self.prices[i]) if i < len(self) else default
+
+    def marginal_price(self, qty: float) -> float:
+        """Price of the last unit when filling qty units, inf if too thin."""
+        i = np.searchsorted(self.cum_qty, qty)
+        return float(self.prices[i]) if i < len(self) else math.inf
+
+    def fill_cost(self, qty: float) -> float:
+        """Total cost of filling qty units, inf if the book is too thin."""
+        if qty <= 0:
+            return 0.0
+        i = np.searchsorted(self.cum_qty, qty)
+        if i >= len(self):
+            return math.inf
+        filled_qty = self.cum_qty[i - 1] if i else 0.0
+        filled_cost = self.cum_cost[i - 1] if i else 0.0
+        return float(filled_cost + (qty - filled_qty) * self.prices[i])
+
+    def average_price(self, qty: float) -> float:
+        return self.fill_cost(qty) / qty
+
+
+def buy_book_price(book: OrderBook) -> float:
+    return book.threshold_price(MIN_TOTAL_COST, MIN_TOTAL_QTY, 0.0)
+
+
+def sell_book_price(book: OrderBook) -> float:
+    return book.threshold_price(MIN_TOTAL_COST, MIN_TOTAL_QTY, math.inf)
+
+
+def buy_order_price(buy_orders: List[Dict[str, Any]]) -> float:
+    return buy_book_price(OrderBook.buy_side(buy_orders))
+
+
+def sell_order_price(
+    sell_orders: List[Dict[str, Any]],
+    location_id: int = world.JITA_4_4_STATION_ID,
+) -> float:
+    return sell_book_price(OrderBook.sell_side(sell_orders, location_id))
+
+
+def best_buy_location(buy_orders: List[Dict[str, Any]]) -> Tuple[int, float]:
+    """Station with the highest buy_order_price(), (ANY_LOCATION, 0) if
+    none has enough depth."""
+    by_location = collections.defaultdict(list)
+    for x in buy_orders:
+        by_location[x["location_id"]].append(x)
+    return max(
+        (
+            (location_id, buy_order_price(orders))
+            for location_id, orders in by_location.items()
+        ),
+        key=lambda r: r[1],
+        default=(ANY_LOCATION, 0.0),
     )
 
 
-def sell_order_price(sell_orders: List[Dict[str, Any]]) -> float:
-    prices = [
-        (x["volume_remain"], x["price"])
-        for x in sell_orders
-        if is_good_sell_order(x)
-    ]
-    prices.sort(key=lambda p: p[1])
-    total_cost = 0.0
-    total_qty = 0.0
-    for p in prices:
-        total_cost += p[0] * p[1]
-        total_qty += p[0]
-        if total_cost >= MIN_TOTAL_COST and total_qty >= MIN_TOTAL_QTY:
-            return p[1]
-    return math.inf
+def best_sell_location(sell_orders: List[Dict[str, Any]]) -> Tuple[int, float]:
+    """Station with the lowest sell_order_price(), (ANY_LOCATION, inf) if
+    none has enough depth."""
+    locations = {x["location_id"] for x in sell_orders}
+    return min(
+        (
+            (location_id, sell_order_price(sell_orders, location_id))
+            for location_id in locations
+        ),
+        key=lambda r: r[1],
+        default=(ANY_LOCATION, math.inf),
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class EsiResponse:
+    # None when ESI confirmed that the stored copy is still current.
+    result: Optional[List[Any]]
+    expires: Optional[datetime.datetime] = None
+    last_modified: Optional[datetime.datetime] = None
+    etag: Optional[str] = None
+    pages: int = 1
+
+
+def parse_http_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    return datetime.datetime.fromtimestamp(
+        email.utils.parsedate_to_datetime(value).timestamp()
+    )
+
+
+def esi_response_from_headers(
+    result: Optional[List[Any]], headers: Any
+) -> EsiResponse:
+    return EsiResponse(
+        result,
+        parse_http_date(headers.get("Expires")),
+        parse_http_date(headers.get("Last-Modified")),
+        headers.get("ETag"),
+        int(headers.get("X-Pages", 1)),
+    )
+
+
+def call_esi(
+    operation: "CallableOperation",
+    etag: Optional[str] = None,
+    priority: int = esi_scheduler.INTERACTIVE,
+    **kwargs,
+) -> EsiResponse:
+    # Runs only once a fetch is needed, so cached runs never load bravado.
+    import bravado.exception
+
+    scheduler = esi_scheduler.default_scheduler
+    route = operation.operation.operation_id
+    options = {"headers": {"If-None-Match": etag}} if etag else {}
+    attempt = 0
+    while True:
+        with instrument.span("esi wait"):
+            scheduler.acquire(route, priority)
+        try:
+            with instrument.span(f"esi {route}"):
+                response = operation(
+                    _request_options=options, **kwargs
+                ).response()
+            result = response.result
+            headers = response.incoming_response.headers
+            scheduler.record(response.incoming_response.status_code, headers)
+            instrument.count(
+                "esi bytes", len(response.incoming_response.raw_bytes)
+            )
+            break
+        except bravado.exception.HTTPError as e:
+            scheduler.record(e.status_code, e.response.headers)
+            if isinstance(e, bravado.exception.HTTPNotModified):
+                result = None
+                headers = e.response.headers
+                break
+            if isinstance(e, bravado.exception.HTTPNotFound):
+                return EsiResponse([])
+            delay = esi_scheduler.retry_delay(e.status_code, attempt)
+            if delay is None:
+                raise
+            logging.warning(
+                "%s failed with %d, retrying", route, e.status_code
+            )
+            time.sleep(delay)
+            attempt += 1
+    return esi_response_from_headers(result, headers)
 
 
 def get_market_orders(
-    api: SwaggerClient, type_id: int, order_type: str
-) -> List[Any]:
-    try:
-        return (
-            api.Market.get_markets_region_id_orders(
-                region_id=world.JITA_REGION_ID,
+    api: "SwaggerClient",
+    type_id: int,
+    order_type: str,
+    etag: Optional[str] = None,
+    priority: int = esi_scheduler.INTERACTIVE,
+    region_id: int = world.JITA_REGION_ID,
+) -> EsiResponse:
+    operation = api.Market.get_markets_region_id_orders
+    response = call_esi(
+        operation,
+        etag,
+        priority,
+        region_id=region_id,
+        type_id=type_id,
+        order_type=order_type,
+    )
+    if response.result is not None:
+        # The ETag only covers the first page, the rest always come with a
+        # body. Items are already fetched in parallel, so pages aren't.
+        for page in range(2, response.pages + 1):
+            more = call_esi(
+                operation,
+                priority=priority,
+                region_id=region_id,
                 type_id=type_id,
                 order_type=order_type,
+                page=page,
             )
-            .response()
-            .result
+            response.result.extend(more.result or [])
+    return response
+
+
+def get_market_history(
+    api: "SwaggerClient",
+    type_id: int,
+    etag: Optional[str] = None,
+    priority: int = esi_scheduler.INTERACTIVE,
+    region_id: int = world.JITA_REGION_ID,
+) -> EsiResponse:
+    return call_esi(
+        api.Market.get_markets_region_id_history,
+        etag,
+        priority,
+        region_id=region_id,
+        type_id=type_id,
+    )
+
+
+MarketOrders = Tuple[List[Any], List[Any]]
+
+
+def get_region_order_pages(
+    api: "SwaggerClient",
+    region_id: int,
+    priority: int = esi_scheduler.INTERACTIVE,
+) -> Iterator[List[Any]]:
+    def fetch_page(page: int) -> EsiResponse:
+        return call_esi(
+            api.Market.get_markets_region_id_orders,
+            priority=priority,
+            region_id=region_id,
+            order_type="all",
+            page=page,
+        )
+
+    # Pages are fetched without an ETag, so they always come with a body.
+    first = fetch_page(1)
+    yield first.result or []
+    pages = first.pages
+    logging.info("retriving %d pages of orders in region %d", pages, region_id)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=PREFETCH_WORKERS
+    ) as pool:
+        for response in pool.map(fetch_page, range(2, pages + 1)):
+            yield response.result or []
+
+
+def store_region_orders(
+    store: db.ConnectionPool,
+    region_id: int,
+    retrieved_on: datetime.datetime,
+    pages: Iterable[List[Any]],
+):
+    """Replaces a region's orders with pages as they are downloaded.
+
+    Pages are staged one at a time, so neither the whole book nor the
+    write lock is held while the rest download; the staged book then
+    replaces the region's orders in one transaction.
+    """
+    with store.writer() as conn, conn:
+        conn.execute(
+            "DELETE FROM eveMarketOrdersStaging WHERE region_id = ?",
+            (region_id,),
         )
-    except bravado.exception.HTTPNotFound:
-        return []
+    for page in pages:
+        with store.writer() as conn, conn:
+            conn.executemany(
+                "REPLACE INTO eveMarketOrdersStaging("
+                "  region_id, type_id, is_buy_order, order_id, "
+                "  location_id, price, volume_remain"
+                ") VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        region_id,
+                        x["type_id"],
+                        x["is_buy_order"],
+                        x["order_id"],
+                        x["location_id"],
+                        x["price"],
+                        x["volume_remain"],
+                    )
+                    for x in page
+                ),
+            )
+    with store.writer() as conn, conn:
+        conn.execute(
+            "DELETE FROM eveMarketOrders WHERE region_id = ?", (region_id,)
+        )
+        conn.execute(
+            "INSERT INTO eveMarketOrders "
+            "SELECT * FROM eveMarketOrdersStaging WHERE region_id = ?",
+            (region_id,),
+        )
+        conn.execute(
+            "DELETE FROM eveMarketOrdersStaging WHERE region_id = ?",
+            (region_id,),
+        )
+        conn.execute(
+            "REPLACE INTO eveMarketOrderSnapshot(region_id, retrieved_on) "
+            "VALUES (?, ?)",
+            (region_id, int(retrieved_on.timestamp())),
+        )
+
+
+def read_region_orders(
+    conn: sqlite3.Connection, region_id: int, type_id: int
+) -> MarketOrders:
+    rows = conn.execute(
+        "SELECT "
+        "  type_id, is_buy_order, order_id, location_id, price, volume_remain "
+        "FROM eveMarketOrders WHERE region_id = ? AND type_id = ?",
+        (region_id, type_id),
+    )
+    buy_orders: List[Any] = []
+    sell_orders: List[Any] = []
+    for row in rows:
+        order = dict(row)
+        order["is_buy_order"] = bool(order["is_buy_order"])
+        (buy_orders if order["is_buy_order"] else sell_orders).append(order)
+    return buy_orders, sell_orders
+
+
+@dataclasses.dataclass(frozen=True)
+class MarketResponses:
+    type_id: int
+    retrieved_on: datetime.datetime
+    history: EsiResponse
+    buy_orders: EsiResponse
+    sell_orders: EsiResponse
+    region_id: int = world.JITA_REGION_ID
+
+    @property
+    def _responses(self) -> Dict[str, EsiResponse]:
+        return {
+            "history": self.history,
+            "buy": self.buy_orders,
+            "sell": self.sell_orders,
+        }
+
+    @property
+    def expires(self) -> Optional[datetime.datetime]:
+        return min(
+            (r.expires for r in self._responses.values() if r.expires),
+            default=None,
+        )
+
+    @property
+    def last_modified(self) -> Optional[datetime.datetime]:
+        return max(
+            (
+                r.last_modified
+                for r in self._responses.values()
+                if r.last_modified
+            ),
+            default=None,
+        )
+
+    @property
+    def etags(self) -> Dict[str, str]:
+        return {k: r.etag for k, r in self._responses.items() if r.etag}
+
+
+def fetch_market_data(
+    api: "SwaggerClient",
+    type_id: int,
+    etags: Optional[Dict[str, str]] = None,
+    orders: Optional[MarketOrders] = None,
+    priority: int = esi_scheduler.INTERACTIVE,
+    region_id: int = world.JITA_REGION_ID,
+) -> MarketResponses:
+    etags = etags or {}
+    history = get_market_history(
+        api, type_id, etags.get("history"), priority, region_id
+    )
+    if orders is None:
+        buy_orders = get_market_orders(
+            api, type_id, "buy", etags.get("buy"), priority, region_id
+        )
+        sell_orders = get_market_orders(
+            api, type_id, "sell", etags.get("sell"), priority, region_id
+        )
+    else:
+        buy_orders = EsiResponse(orders[0])
+        sell_orders = EsiResponse(orders[1])
+    return MarketResponses(
+        type_id,
+        datetime.datetime.now(),
+        history,
+        buy_orders,
+        sell_orders,
+        region_id,
+    )
+
+
+# Type id, stored ETags and, in snapshot mode, the orders to use.
+FetchRequest = Tuple[int, Optional[Dict[str, str]], Optional[MarketOrders]]
+
+
+class MarketFetcher(abc.ABC):
+    @abc.abstractmethod
+    def fetch_many(
+        self,
+        requests: List[FetchRequest],
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: int = world.JITA_REGION_ID,
+    ) -> Iterator[MarketResponses]:
+        """Yields responses for every request, in any order."""
 
 
-def get_market_data(api: SwaggerClient, type_id: int) -> ItemPriceWithDetails:
+class ThreadedFetcher(MarketFetcher):
+    def __init__(
+        self,
+        get_api: Callable[[], "SwaggerClient"],
+        workers: int = PREFETCH_WORKERS,
+    ):
+        self.get_api = get_api
+        self.workers = workers
+
+    def fetch_many(
+        self,
+        requests: List[FetchRequest],
+        priority: int = esi_scheduler.INTERACTIVE,
+        region_id: int = world.JITA_REGION_ID,
+    ) -> Iterator[MarketResponses]:
+        api = self.get_api()
+        if len(requests) == 1:
+            yield fetch_market_data(api, *requests[0], priority, region_id)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers
+        ) as pool:
+            futures = [
+                pool.submit(fetch_market_data, api, *r, priority, region_id)
+                for r in requests
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+
+@instrument.timed("make_item_price")
+def make_item_price(
+    type_id: int,
+    retrieved_on: datetime.datetime,
+    history: List[Any],
+    buy_orders: List[Any],
+    sell_orders: List[Any],
+    location_id: int = world.JITA_4_4_STATION_ID,
+) -> ItemPriceWithDetails:
     low_price = 0.0
     high_price = math.inf
     daily_trade_volume = 0.0
 
-    try:
-        history = (
-            api.Market.get_markets_region_id_history(
-                region_id=world.JITA_REGION_ID, type_id=type_id
-            )
-            .response()
-            .result
-        )
-        history = sorted(history, key=lambda d: d["date"])
-        if len(history) > 180:
-            history = history[-180:]
-        history = list(history)
-        if len(history) > 30:
-            short = history[-30:]
-        else:
-            short = history[:]
-        if short:
-            daily_trade_volume = sum([d["volume"] for d in short]) / len(short)
-        valid_days = [d for d in short if d["volume"] >= MIN_TOTAL_QTY]
-        if len(valid_days) > 10:
-            low_price = BUY_ORDER_SETUP_DISCOUNT * min(
-                d["lowest"] for d in valid_days
-            )
-            high_price = SELL_ORDER_SETUP_DISCOUNT * max(
-                d["highest"] for d in valid_days
-            )
-    except bravado.exception.HTTPNotFound:
-        history = []
-        pass
-
-    buy_orders = get_market_orders(api, type_id, "buy")
-    low_price = max(low_price, buy_order_price(buy_orders))
+    history = sorted(history, key=lambda d: d["date"])
+    if len(history) > 30:
+        short = history[-30:]
+    else:
+        short = history[:]
+    if short:
+        daily_trade_volume = sum([d["volume"] for d in short]) / len(short)
+    valid_days = [d for d in short if d["volume"] >= MIN_TOTAL_QTY]
+    if len(valid_days) > 10:
+        low_price = BUY_ORDER_SETUP_DISCOUNT * min(
+            d["lowest"] for d in valid_days
+        )
+        high_price = SELL_ORDER_SETUP_DISCOUNT * max(
+            d["highest"] for d in valid_days
+        )
 
-    sell_orders = get_market_orders(api, type_id, "sell")
-    high_price = min(high_price, sell_order_price(sell_orders))
+    buy_book = OrderBook.buy_side(buy_orders)
+    sell_book = OrderBook.sell_side(sell_orders, location_id)
+    low_price = max(low_price, buy_book_price(buy_book))
+    high_price = min(high_price, sell_book_price(sell_book))
 
     return ItemPriceWithDetails(
         ItemPrice(
             type_id,
-            datetime.datetime.now(),
+            retrieved_on,
             daily_trade_volume,
             low_price,
             high_price,
@@ -161,107 +723,652 @@ def get_market_data(api: SwaggerClient, type_id: int) -> ItemPriceWithDetails:
         history,
         buy_orders,
         sell_orders,
+        buy_book,
+        sell_book,
+        location_id,
     )
 
 
-def store_item_price(conn: sqlite3.Connection, ipwd: ItemPriceWithDetails):
-    ip = ipwd.item_price
+def _db_timestamp(d: Optional[datetime.datetime]) -> Optional[int]:
+    return int(d.timestamp()) if d else None
+
+
+def store_item_prices(
+    conn: sqlite3.Connection,
+    batch: List[Tuple[ItemPriceWithDetails, MarketResponses]],
+):
+    # The whole batch is written in one transaction.
     with conn:
-        conn.execute(
+        conn.executemany(
             "REPLACE INTO eveMarket( "
-            "  type_id,  last_refreshed, daily_trade_volume, "
-            "  low_price, high_price, history"
-            ") VALUES (?, ?, ?, ?, ?, ?)",
+            "  type_id, region_id, location_id, "
+            "  last_refreshed, daily_trade_volume, "
+            "  low_price, high_price, expires, last_modified, etags"
+            ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
             (
-                ip.type_id,
-                int(ip.last_refreshed.timestamp()),
-                ip.daily_trade_volume,
-                ip.low_price,
-                ip.high_price,
-                adopt_json_for_db(ipwd.history),
+                (
+                    ipwd.item_price.type_id,
+                    responses.region_id,
+                    ipwd.location_id,
+                    int(ipwd.item_price.last_refreshed.timestamp()),
+                    ipwd.item_price.daily_trade_volume,
+                    ipwd.item_price.low_price,
+                    ipwd.item_price.high_price,
+                    _db_timestamp(responses.expires),
+                    _db_timestamp(responses.last_modified),
+                    json.dumps(responses.etags),
+                )
+                for ipwd, responses in batch
             ),
         )
-        if ipwd.sell_orders or ipwd.buy_orders:
-            conn.execute(
-                "INSERT INTO eveMarketHistory("
-                "   type_id, retrieved_on, buy_orders, sell_orders) "
-                "VALUES (?, ?, ?, ?)",
-                (
-                    ip.type_id,
-                    int(ip.last_refreshed.timestamp()),
-                    adopt_json_for_db(ipwd.buy_orders),
-                    adopt_json_for_db(ipwd.sell_orders),
-                ),
+        for region_id in {responses.region_id for _, responses in batch}:
+            store_histories(
+                conn,
+                {
+                    ipwd.item_price.type_id: ipwd.history
+                    for ipwd, responses in batch
+                    if responses.region_id == region_id
+                    and responses.history.result is not None
+                },
+                region_id,
             )
+        for ipwd, responses in batch:
+            orders_changed = (
+                responses.buy_orders.result is not None
+                or responses.sell_orders.result is not None
+            )
+            if orders_changed and (ipwd.sell_orders or ipwd.buy_orders):
+                order_snapshots.store_order_snapshot(
+                    conn,
+                    ipwd.item_price.type_id,
+                    ipwd.item_price.last_refreshed,
+                    ipwd.buy_orders,
+                    ipwd.sell_orders,
+                    responses.region_id,
+                )
+
+
+def store_item_price(
+    conn: sqlite3.Connection,
+    ipwd: ItemPriceWithDetails,
+    responses: MarketResponses,
+):
+    store_item_prices(conn, [(ipwd, responses)])
+
 
+def store_histories(
+    conn: sqlite3.Connection,
+    histories: Dict[int, List[Dict[str, Any]]],
+    region_id: int = world.JITA_REGION_ID,
+):
+    # Only days from the last stored one on are written; it is rewritten
+    # in case it was still being traded when stored.
+    last_dates = dict(
+        conn.execute(
+            "SELECT type_id, MAX(date) FROM eveMarketDaily "
+            "WHERE region_id = ? "
+            "  AND type_id IN (SELECT value FROM json_each(?)) "
+            "GROUP BY type_id",
+            (region_id, json.dumps(list(histories))),
+        )
+    )
+    rows = []
+    for type_id, history in histories.items():
+        last_date = last_dates.get(type_id) or ""
+        for d in history:
+            date = adopt_value_for_db(d["date"])
+            if date >= last_date:
+                rows.append(
+                    (
+                        region_id,
+                        type_id,
+                        date,
+                        d["average"],
+                        d["lowest"],
+                        d["highest"],
+                        d["volume"],
+                        d["order_count"],
+                    )
+                )
+    conn.executemany(
+        "REPLACE INTO eveMarketDaily("
+        "  region_id, type_id, date, "
+        "  average, lowest, highest, volume, order_count"
+        ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
 
+
+def store_history(
+    conn: sqlite3.Connection,
+    type_id: int,
+    history: List[Dict[str, Any]],
+    region_id: int = world.JITA_REGION_ID,
+):
+    store_histories(conn, {type_id: history}, region_id)
+
+
+def read_item_prices(
+    conn: sqlite3.Connection,
+    type_ids: Iterable[int],
+    region_id: int = world.JITA_REGION_ID,
+    location_id: int = world.JITA_4_4_STATION_ID,
+) -> Dict[int, sqlite3.Row]:
+    rows = conn.execute(
+        "SELECT "
+        "  type_id, last_refreshed, daily_trade_volume, "
+        "  low_price, high_price, expires, etags "
+        "FROM eveMarket "
+        "WHERE region_id = ? AND location_id = ? "
+        "  AND type_id IN (SELECT value FROM json_each(?))",
+        (region_id, location_id, json.dumps(list(type_ids))),
+    )
+    return {row["type_id"]: row for row in rows}
+
+
+def read_histories(
+    conn: sqlite3.Connection,
+    type_ids: Iterable[int],
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None,
+    region_id: int = world.JITA_REGION_ID,
+) -> Dict[int, PriceSeries]:
+    type_ids = list(type_ids)
+    rows = conn.execute(
+        "SELECT "
+        "  type_id, date, average, lowest, highest, volume, order_count "
+        "FROM eveMarketDaily "
+        "WHERE region_id = ? "
+        "  AND type_id IN (SELECT value FROM json_each(?)) "
+        "  AND date >= ? AND date <= ? "
+        "ORDER BY type_id, date",
+        (
+            region_id,
+            json.dumps(type_ids),
+            start.isoformat() if start else "",
+            end.isoformat() if end else "9999-12-31",
+        ),
+    )
+    r = {
+        type_id: PriceSeries.from_rows(tuple(row)[1:] for row in days)
+        for type_id, days in itertools.groupby(rows, lambda row: row[0])
+    }
+    return {
+        type_id: r[type_id] if type_id in r else PriceSeries.from_rows([])
+        for type_id in type_ids
+    }
+
+
+@instrument.timed("parse_history")
 def parse_history(data: List[Dict[str, Any]]) -> List[HistoricalItemPrice]:
-    return [dataclass_from_row(HistoricalItemPrice, d) for d in data]
+    return dataclasses_from_rows(HistoricalItemPrice, data)
 
 
 class ItemPriceCache:
-    def __init__(self, conn: sqlite3.Connection, api: SwaggerClient):
-        self.conn = conn
-        self.api = api
+    def __init__(
+        self,
+        store: db.ConnectionPool,
+        get_api: Callable[[], "SwaggerClient"],
+        use_order_snapshot: bool = False,
+        fetcher: Optional[MarketFetcher] = None,
+        priority: int = esi_scheduler.INTERACTIVE,
+        trust_refresher: bool = True,
+        region_id: int = world.JITA_REGION_ID,
+        location_id: int = world.JITA_4_4_STATION_ID,
+        offline: bool = False,
+    ):
+        self.store = store
+        self._get_api = get_api
+        self.use_order_snapshot = use_order_snapshot
+        self.fetcher = fetcher or ThreadedFetcher(get_api)
+        self.priority = priority
+        self.region_id = region_id
+        self.location_id = location_id
+        # Offline, whatever is stored is served no matter how old it is and
+        # nothing is ever fetched.
+        self.offline = offline
+        self._reported_ages: Set[int] = set()
+        # Items a running refresher keeps warm here. Their stored prices
+        # are served for the whole freshness window rather than only until
+        # ESI's Expires; everything else is checked as usual.
+        self.refresher_items: Set[int] = set()
+        if trust_refresher and is_refresher_alive(self.conn):
+            self.refresher_items = read_refresher_items(
+                self.conn, region_id, location_id
+            )
+            logging.info(
+                "refresher is running, using stored prices for %d items",
+                len(self.refresher_items),
+            )
 
-    def _is_fresh(self, d: datetime.datetime) -> bool:
-        return datetime.datetime.now() - d <= datetime.timedelta(
-            hours=random.uniform(3, 3)
-        )
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.store.reader()
 
-    def find_item_price(self, item_type: world.ItemType) -> ItemPrice:
-        ip = dataclass_from_row(
-            ItemPrice,
-            self.conn.execute(
-                "SELECT "
-                "  type_id, last_refreshed, daily_trade_volume, "
-                "  low_price, high_price "
-                "FROM eveMarket WHERE type_id = ?",
-                (item_type.id,),
-            ).fetchone(),
-        )
-        if self._is_fresh(ip.last_refreshed):
-            return ip
-        logging.info("retriving pricing data for %s", item_type.name)
-        ipwd = get_market_data(self.api, item_type.id)
-        store_item_price(self.conn, ipwd)
-        return ipwd.item_price
+    @property
+    def api(self) -> "SwaggerClient":
+        return self._get_api()
 
-    def get_price_history(
-        self, item_type: world.ItemType
-    ) -> List[HistoricalItemPrice]:
+    def _is_fresh(
+        self,
+        d: datetime.datetime,
+        expires: Optional[int] = None,
+        type_id: Optional[int] = None,
+    ) -> bool:
+        if self.offline:
+            return True
+        if (
+            type_id in self.refresher_items
+            and datetime.datetime.now() - d <= FRESHNESS_WINDOW
+        ):
+            return True
+        if expires is not None:
+            return datetime.datetime.now().timestamp() < expires
+        return datetime.datetime.now() - d <= FRESHNESS_WINDOW
+
+    def refresh_order_snapshot(self, region_id: Optional[int] = None):
+        if self.offline:
+            return
+        region_id = region_id or self.region_id
         row = self.conn.execute(
-            "SELECT last_refreshed, history "
-            "FROM eveMarket WHERE type_id = ?",
-            (item_type.id,),
+            "SELECT retrieved_on FROM eveMarketOrderSnapshot "
+            "WHERE region_id = ?",
+            (region_id,),
         ).fetchone()
         if row and self._is_fresh(datetime.datetime.fromtimestamp(row[0])):
-            return parse_history(json.loads(row[1]))
+            return
+        retrieved_on = datetime.datetime.now()
+        store_region_orders(
+            self.store,
+            region_id,
+            retrieved_on,
+            get_region_order_pages(self.api, region_id, self.priority),
+        )
+
+    def _snapshot_orders(self, type_id: int) -> Optional[MarketOrders]:
+        if not self.use_order_snapshot:
+            return None
+        self.refresh_order_snapshot()
+        return read_region_orders(self.conn, self.region_id, type_id)
+
+    def _price(self, responses: MarketResponses) -> ItemPriceWithDetails:
+        type_id = responses.type_id
+        history = responses.history.result
+        if history is None:
+            stored = read_histories(
+                self.conn, [type_id], region_id=self.region_id
+            )
+            history = [dataclasses.asdict(h) for h in stored[type_id]]
+        buy_orders = responses.buy_orders.result
+        sell_orders = responses.sell_orders.result
+        if buy_orders is None or sell_orders is None:
+            snapshot = order_snapshots.read_order_snapshot(
+                self.conn, type_id, region_id=self.region_id
+            )
+            _, stored_buy, stored_sell = snapshot or (None, [], [])
+            if buy_orders is None:
+                buy_orders = stored_buy
+            if sell_orders is None:
+                sell_orders = stored_sell
+        return make_item_price(
+            type_id,
+            responses.retrieved_on,
+            history,
+            buy_orders,
+            sell_orders,
+            self.location_id,
+        )
+
+    def _fetch(
+        self, stale: Dict[world.ItemType, Optional[Dict[str, str]]]
+    ) -> List[ItemPriceWithDetails]:
+        requests = [
+            (it.id, etags, self._snapshot_orders(it.id))
+            for it, etags in stale.items()
+        ]
+        # The connection belongs to this thread, so fetchers only fetch.
+        batch = [
+            (self._price(responses), responses)
+            for responses in self.fetcher.fetch_many(
+                requests, self.priority, self.region_id
+            )
+        ]
+        with self.store.writer() as conn:
+            store_item_prices(conn, batch)
+        return [ipwd for ipwd, _ in batch]
+
+    def _refresh(
+        self, item_type: world.ItemType, etags: Optional[Dict[str, str]]
+    ) -> ItemPriceWithDetails:
         logging.info("retriving pricing data for %s", item_type.name)
-        ipwd = get_market_data(self.api, item_type.id)
-        store_item_price(self.conn, ipwd)
-        return parse_history(ipwd.history)
+        return self._fetch({item_type: etags})[0]
+
+    def refresh(self, item_type: world.ItemType) -> ItemPriceWithDetails:
+        row = read_item_prices(
+            self.conn, [item_type.id], self.region_id, self.location_id
+        ).get(item_type.id)
+        etags = json.loads(row["etags"]) if row and row["etags"] else None
+        return self._refresh(item_type, etags)
+
+    def _find_stale_items(
+        self, items: Iterable[world.ItemType]
+    ) -> Dict[world.ItemType, Optional[Dict[str, str]]]:
+        by_id = {it.id: it for it in items}
+        stale: Dict[world.ItemType, Optional[Dict[str, str]]] = {
+            it: None for it in by_id.values()
+        }
+        rows = read_item_prices(
+            self.conn, by_id, self.region_id, self.location_id
+        )
+        for type_id, row in rows.items():
+            it = by_id[type_id]
+            if self._is_fresh(
+                datetime.datetime.fromtimestamp(row["last_refreshed"]),
+                row["expires"],
+                type_id,
+            ):
+                instrument.count("cache hit", key=it.name)
+                del stale[it]
+                continue
+            instrument.count("cache stale", key=it.name)
+            if row["etags"]:
+                stale[it] = json.loads(row["etags"])
+        for it in stale:
+            if it.id not in rows:
+                instrument.count("cache miss", key=it.name)
+        return stale
+
+    def _report_ages(self, items: Iterable[world.ItemType]):
+        items = [it for it in items if it.id not in self._reported_ages]
+        rows = read_item_prices(
+            self.conn,
+            (it.id for it in items),
+            self.region_id,
+            self.location_id,
+        )
+        now = datetime.datetime.now()
+        for it in items:
+            self._reported_ages.add(it.id)
+            row = rows.get(it.id)
+            if row is None:
+                logging.warning("no stored price for %s", it.name)
+                continue
+            age = now - datetime.datetime.fromtimestamp(row["last_refreshed"])
+            logging.info(
+                "price of %s is %s old",
+                it.name,
+                datetime.timedelta(seconds=int(age.total_seconds())),
+            )
+
+    def prefetch(self, items: Iterable[world.ItemType]):
+        if self.offline:
+            self._report_ages(items)
+            return
+        stale = self._find_stale_items(items)
+        if not stale:
+            return
+        logging.info("retriving pricing data for %d items", len(stale))
+        self._fetch(stale)
+
+    def find_item_price(self, item_type: world.ItemType) -> ItemPrice:
+        return self.find_item_prices([item_type])[item_type]
+
+    def find_item_prices(
+        self, items: Iterable[world.ItemType]
+    ) -> Dict[world.ItemType, ItemPrice]:
+        items = list(items)
+        self.prefetch(items)
+        rows = read_item_prices(
+            self.conn,
+            (it.id for it in items),
+            self.region_id,
+            self.location_id,
+        )
+        return {
+            it: dataclass_from_row(ItemPrice, rows.get(it.id)) for it in items
+        }
+
+    def get_orders(
+        self, items: Iterable[world.ItemType]
+    ) -> Dict[world.ItemType, MarketOrders]:
+        """Latest stored buy and sell orders across the whole region."""
+        items = list(items)
+        self.prefetch(items)
+        r = {}
+        for it in items:
+            snapshot = order_snapshots.read_order_snapshot(
+                self.conn, it.id, region_id=self.region_id
+            )
+            _, buy_orders, sell_orders = snapshot or (None, [], [])
+            r[it] = (buy_orders, sell_orders)
+        return r
+
+    def get_order_books(
+        self, items: Iterable[world.ItemType]
+    ) -> Dict[world.ItemType, Tuple[OrderBook, OrderBook]]:
+        """Buy and sell side books from the latest stored orders."""
+        return {
+            it: (
+                OrderBook.buy_side(buy_orders),
+                OrderBook.sell_side(sell_orders, self.location_id),
+            )
+            for it, (buy_orders, sell_orders) in self.get_orders(items).items()
+        }
+
+    def get_price_history(self, item_type: world.ItemType) -> PriceSeries:
+        return self.get_price_histories([item_type])[item_type]
+
+    def get_price_histories(
+        self,
+        items: Iterable[world.ItemType],
+        start: Optional[datetime.date] = None,
+        end: Optional[datetime.date] = None,
+    ) -> Dict[world.ItemType, PriceSeries]:
+        items = list(items)
+        self.prefetch(items)
+        hist = read_histories(
+            self.conn, (it.id for it in items), start, end, self.region_id
+        )
+        return {it: hist[it.id] for it in items}
+
+
+def record_refresher_heartbeat(
+    conn: sqlite3.Connection, next_beat: datetime.datetime
+):
+    with conn:
+        conn.execute(
+            "REPLACE INTO eveMarketRefresher VALUES (0, ?, ?)",
+            (
+                os.getpid(),
+                _db_timestamp(next_beat + REFRESHER_HEARTBEAT_GRACE),
+            ),
+        )
+
+
+def is_refresher_alive(conn: sqlite3.Connection) -> bool:
+    row = conn.execute(
+        "SELECT alive_until FROM eveMarketRefresher WHERE id = 0"
+    ).fetchone()
+    return bool(row) and datetime.datetime.now().timestamp() < row[0]
+
+
+def record_refresher_items(
+    conn: sqlite3.Connection,
+    region_id: int,
+    location_id: int,
+    type_ids: Iterable[int],
+):
+    with conn:
+        conn.execute(
+            "DELETE FROM eveMarketRefresherItems "
+            "WHERE region_id = ? AND location_id = ?",
+            (region_id, location_id),
+        )
+        conn.executemany(
+            "INSERT INTO eveMarketRefresherItems VALUES (?, ?, ?)",
+            ((region_id, location_id, type_id) for type_id in type_ids),
+        )
+
+
+def read_refresher_items(
+    conn: sqlite3.Connection, region_id: int, location_id: int
+) -> Set[int]:
+    return {
+        type_id
+        for type_id, in conn.execute(
+            "SELECT type_id FROM eveMarketRefresherItems "
+            "WHERE region_id = ? AND location_id = ?",
+            (region_id, location_id),
+        )
+    }
 
 
 def create_tables(conn: sqlite3.Connection):
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS "eveMarket" (
-            "type_id" INTEGER PRIMARY KEY NOT NULL,
+            "type_id" INTEGER NOT NULL,
+            "region_id" INTEGER NOT NULL,
+            "location_id" INTEGER NOT NULL,
             "last_refreshed" INTEGER NOT NULL,
             "daily_trade_volume" REAL NOT NULL,
             "low_price" REAL NOT NULL,
             "high_price" REAL NOT NULL,
-            "history" JSON NOT NULL
+            "expires" INTEGER,
+            "last_modified" INTEGER,
+            "etags" JSON,
+            PRIMARY KEY ("region_id", "location_id", "type_id")
+        );
+        """)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveMarketOrders" (
+            "region_id" INTEGER NOT NULL,
+            "type_id" INTEGER NOT NULL,
+            "is_buy_order" BOOLEAN NOT NULL,
+            "order_id" INTEGER NOT NULL,
+            "location_id" INTEGER NOT NULL,
+            "price" REAL NOT NULL,
+            "volume_remain" INTEGER NOT NULL,
+            PRIMARY KEY ("region_id", "type_id", "is_buy_order", "order_id")
         );
         """)
     conn.execute(
         """
-        CREATE TABLE IF NOT EXISTS "eveMarketHistory" (
+        CREATE TABLE IF NOT EXISTS "eveMarketOrdersStaging" (
+            "region_id" INTEGER NOT NULL,
             "type_id" INTEGER NOT NULL,
-            "retrieved_on" INTEGER NOT NULL,
-            "buy_orders" JSON NOT NULL,
-            "sell_orders" JSON NOT NULL,
-            PRIMARY KEY ("type_id", "retrieved_on")
+            "is_buy_order" BOOLEAN NOT NULL,
+            "order_id" INTEGER NOT NULL,
+            "location_id" INTEGER NOT NULL,
+            "price" REAL NOT NULL,
+            "volume_remain" INTEGER NOT NULL,
+            PRIMARY KEY ("region_id", "type_id", "is_buy_order", "order_id")
         );
         """)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveMarketOrderSnapshot" (
+            "region_id" INTEGER PRIMARY KEY NOT NULL,
+            "retrieved_on" INTEGER NOT NULL
+        );
+        """)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveMarketDaily" (
+            "region_id" INTEGER NOT NULL,
+            "type_id" INTEGER NOT NULL,
+            "date" TEXT NOT NULL,
+            "average" REAL NOT NULL,
+            "lowest" REAL NOT NULL,
+            "highest" REAL NOT NULL,
+            "volume" INTEGER NOT NULL,
+            "order_count" INTEGER NOT NULL,
+            PRIMARY KEY ("region_id", "type_id", "date")
+        ) WITHOUT ROWID;
+        """)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveMarketRefresher" (
+            "id" INTEGER PRIMARY KEY NOT NULL CHECK ("id" = 0),
+            "pid" INTEGER NOT NULL,
+            "alive_until" INTEGER NOT NULL
+        );
+        """)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveMarketRefresherItems" (
+            "region_id" INTEGER NOT NULL,
+            "location_id" INTEGER NOT NULL,
+            "type_id" INTEGER NOT NULL,
+            PRIMARY KEY ("region_id", "location_id", "type_id")
+        ) WITHOUT ROWID;
+        """)
+    order_snapshots.create_tables(conn)
+    esi_scheduler.create_tables(conn)
+    _migrate_history_blobs(conn)
+    _add_missing_columns(
+        conn,
+        "eveMarket",
+        {"expires": "INTEGER", "last_modified": "INTEGER", "etags": "JSON"},
+    )
+    # Stores from before prices were kept per region only hold Jita.
+    db.rebuild_with_key_columns(
+        conn,
+        "eveMarket",
+        create_tables,
+        {
+            "region_id": world.JITA_REGION_ID,
+            "location_id": world.JITA_4_4_STATION_ID,
+        },
+    )
+    db.rebuild_with_key_columns(
+        conn,
+        "eveMarketDaily",
+        create_tables,
+        {"region_id": world.JITA_REGION_ID},
+    )
+
+
+def _add_missing_columns(
+    conn: sqlite3.Connection, table: str, columns: Dict[str, str]
+):
+    existing = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})")]
+    for name, column_type in columns.items():
+        if name not in existing:
+            conn.execute(
+                f'ALTER TABLE {table} ADD COLUMN "{name}" {column_type}'
+            )
+
+
+def _migrate_history_blobs(conn: sqlite3.Connection):
+    columns = [r["name"] for r in conn.execute("PRAGMA table_info(eveMarket)")]
+    if "history" not in columns:
+        return
+    logging.info("moving price history into eveMarketDaily")
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO eveMarketDaily("
+            "  region_id, type_id, date, "
+            "  average, lowest, highest, volume, order_count"
+            f") SELECT {world.JITA_REGION_ID}, "
+            "  M.type_id, json_extract(H.value, '$.date'), "
+            "  json_extract(H.value, '$.average'), "
+            "  json_extract(H.value, '$.lowest'), "
+            "  json_extract(H.value, '$.highest'), "
+            "  json_extract(H.value, '$.volume'), "
+            "  json_extract(H.value, '$.order_count') "
+            "FROM eveMarket M, json_each(M.history) H"
+        )
+        conn.execute("ALTER TABLE eveMarket RENAME TO eveMarketOld")
+        create_tables(conn)
+        conn.execute(
+            "INSERT INTO eveMarket("
+            "  type_id, region_id, location_id, "
+            "  last_refreshed, daily_trade_volume, low_price, high_price"
+            f") SELECT type_id, {world.JITA_REGION_ID}, "
+            f"  {world.JITA_4_4_STATION_ID}, "
+            "  last_refreshed, daily_trade_volume, low_price, high_price "
+            "FROM eveMarketOld"
+        )
+        conn.execute("DROP TABLE eveMarketOld")
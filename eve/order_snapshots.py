@@ -0,0 +1,187 @@
+import datetime
+import json
+import logging
+import sqlite3
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from eve import db, world
+from eve.orm_util import adopt_json_for_db
+
+# Every Nth snapshot of a type is stored in full, so reading any
+# snapshot applies at most N - 1 deltas.
+KEYFRAME_INTERVAL = 24
+RETENTION_DAYS = 90
+
+OrderSnapshot = Tuple[datetime.datetime, List[Any], List[Any]]
+
+
+def _encode(data: Dict[str, Any]) -> bytes:
+    return zlib.compress(adopt_json_for_db(data).encode())
+
+
+def _decode(blob: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(blob))
+
+
+def _split(orders: Dict[int, Any]) -> Tuple[List[Any], List[Any]]:
+    buy_orders = [x for x in orders.values() if x["is_buy_order"]]
+    sell_orders = [x for x in orders.values() if not x["is_buy_order"]]
+    return buy_orders, sell_orders
+
+
+def _read_orders(
+    conn: sqlite3.Connection, region_id: int, type_id: int, retrieved_on: int
+) -> Optional[Tuple[int, int, Dict[int, Any]]]:
+    rows = conn.execute(
+        "SELECT retrieved_on, is_keyframe, data FROM eveOrderSnapshot "
+        "WHERE region_id = ? AND type_id = ? AND retrieved_on <= ? "
+        "AND retrieved_on >= ("
+        "  SELECT MAX(retrieved_on) FROM eveOrderSnapshot "
+        "  WHERE region_id = ? AND type_id = ? AND retrieved_on <= ? "
+        "  AND is_keyframe"
+        ") ORDER BY retrieved_on",
+        (region_id, type_id, retrieved_on) * 2,
+    ).fetchall()
+    if not rows:
+        return None
+    orders: Dict[int, Any] = {}
+    for row in rows:
+        data = _decode(row["data"])
+        if row["is_keyframe"]:
+            orders = {x["order_id"]: x for x in data["orders"]}
+            continue
+        for order_id in data["removed"]:
+            del orders[order_id]
+        for x in data["upserted"]:
+            orders[x["order_id"]] = x
+    return rows[-1]["retrieved_on"], len(rows) - 1, orders
+
+
+def read_order_snapshot(
+    conn: sqlite3.Connection,
+    type_id: int,
+    at: Optional[datetime.datetime] = None,
+    region_id: int = world.JITA_REGION_ID,
+) -> Optional[OrderSnapshot]:
+    r = _read_orders(
+        conn, region_id, type_id, int(at.timestamp()) if at else 2 ** 62
+    )
+    if r is None:
+        return None
+    retrieved_on, _, orders = r
+    return (datetime.datetime.fromtimestamp(retrieved_on), *_split(orders))
+
+
+def store_order_snapshot(
+    conn: sqlite3.Connection,
+    type_id: int,
+    retrieved_on: datetime.datetime,
+    buy_orders: List[Any],
+    sell_orders: List[Any],
+    region_id: int = world.JITA_REGION_ID,
+):
+    # Round-trip through JSON so orders compare equal to stored ones.
+    orders = {
+        x["order_id"]: x
+        for x in json.loads(adopt_json_for_db(buy_orders + sell_orders))
+    }
+    ts = int(retrieved_on.timestamp())
+    prev = _read_orders(conn, region_id, type_id, ts - 1)
+    if prev is None or prev[1] + 1 >= KEYFRAME_INTERVAL:
+        is_keyframe = True
+        data = {"orders": list(orders.values())}
+    else:
+        prev_orders = prev[2]
+        is_keyframe = False
+        data = {
+            "removed": [id for id in prev_orders if id not in orders],
+            "upserted": [
+                x for id, x in orders.items() if prev_orders.get(id) != x
+            ],
+        }
+    conn.execute(
+        "REPLACE INTO eveOrderSnapshot("
+        "  region_id, type_id, retrieved_on, is_keyframe, data"
+        ") VALUES (?, ?, ?, ?, ?)",
+        (region_id, type_id, ts, is_keyframe, _encode(data)),
+    )
+
+
+def _migrate_legacy_snapshots(conn: sqlite3.Connection):
+    if not conn.execute(
+        "SELECT 1 FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'eveMarketHistory'"
+    ).fetchone():
+        return
+    logging.info("moving eveMarketHistory into eveOrderSnapshot")
+    rows = conn.execute(
+        "SELECT type_id, retrieved_on, buy_orders, sell_orders "
+        "FROM eveMarketHistory ORDER BY type_id, retrieved_on"
+    )
+    for row in rows:
+        store_order_snapshot(
+            conn,
+            row["type_id"],
+            datetime.datetime.fromtimestamp(row["retrieved_on"]),
+            json.loads(row["buy_orders"]),
+            json.loads(row["sell_orders"]),
+        )
+    conn.execute("DROP TABLE eveMarketHistory")
+
+
+def compact_order_snapshots(
+    conn: sqlite3.Connection, retention_days: int = RETENTION_DAYS
+):
+    cutoff = int(
+        (
+            datetime.datetime.now() - datetime.timedelta(days=retention_days)
+        ).timestamp()
+    )
+    with conn:
+        _migrate_legacy_snapshots(conn)
+        # The oldest kept snapshot of each type must not depend on the
+        # deltas about to be dropped.
+        rows = conn.execute(
+            "SELECT region_id, type_id, MIN(retrieved_on) "
+            "FROM eveOrderSnapshot WHERE retrieved_on >= ? "
+            "GROUP BY region_id, type_id",
+            (cutoff,),
+        ).fetchall()
+        for region_id, type_id, retrieved_on in rows:
+            r = _read_orders(conn, region_id, type_id, retrieved_on)
+            assert r is not None
+            conn.execute(
+                "UPDATE eveOrderSnapshot SET is_keyframe = 1, data = ? "
+                "WHERE region_id = ? AND type_id = ? AND retrieved_on = ?",
+                (
+                    _encode({"orders": list(r[2].values())}),
+                    region_id,
+                    type_id,
+                    retrieved_on,
+                ),
+            )
+        deleted = conn.execute(
+            "DELETE FROM eveOrderSnapshot WHERE retrieved_on < ?", (cutoff,)
+        ).rowcount
+    logging.info("dropped %d order snapshots", deleted)
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "eveOrderSnapshot" (
+            "region_id" INTEGER NOT NULL,
+            "type_id" INTEGER NOT NULL,
+            "retrieved_on" INTEGER NOT NULL,
+            "is_keyframe" BOOLEAN NOT NULL,
+            "data" BLOB NOT NULL,
+            PRIMARY KEY ("region_id", "type_id", "retrieved_on")
+        ) WITHOUT ROWID;
+        """)
+    db.rebuild_with_key_columns(
+        conn,
+        "eveOrderSnapshot",
+        create_tables,
+        {"region_id": world.JITA_REGION_ID},
+    )
@@ -1,32 +1,84 @@
-from typing import Any, Callable, Dict, TypeVar, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
 import sqlite3
 import dataclasses
 import datetime
+import functools
 import json
 
 T = TypeVar("T")
 
+Row = Union[sqlite3.Row, Dict[str, Any]]
 
-def dataclass_from_row(
-    cls: Callable[..., T], row: Union[sqlite3.Row, Dict[str, Any]]
-) -> T:
+
+@functools.lru_cache(maxsize=None)
+def row_converter(cls: Callable[..., T]) -> Callable[[Row], T]:
+    # Generates the field-by-field conversion once per class, so rows
+    # don't pay for dataclasses.fields() and type dispatch every time.
+    env: Dict[str, Any] = {
+        "cls": cls,
+        "new": object.__new__,
+        "fromtimestamp": datetime.datetime.fromtimestamp,
+        "fromisoformat": datetime.date.fromisoformat,
+    }
+    fields = dataclasses.fields(cls)
+    lines = ["def convert(row):"]
+    args = []
+    for i, f in enumerate(fields):
+        env[f"t{i}"] = f.type
+        if f.type is datetime.datetime:
+            conv = "fromtimestamp(v)"
+        elif f.type is datetime.date:
+            conv = "fromisoformat(v)"
+        else:
+            conv = f"t{i}(v)"
+        lines += [
+            f"    v = row[{f.name!r}]",
+            f"    a{i} = v if type(v) is t{i} else {conv}",
+        ]
+        args.append(f"{f.name}=a{i}")
+    # Frozen dataclasses set every field through object.__setattr__ in
+    # __init__; filling __dict__ directly is much cheaper when __init__
+    # does nothing else.
+    plain_init = (
+        "__slots__" not in cls.__dict__
+        and not hasattr(cls, "__post_init__")
+        and all(f.init for f in fields)
+    )
+    if plain_init:
+        lines += [
+            "    obj = new(cls)",
+            f"    obj.__dict__.update({', '.join(args)})",
+            "    return obj",
+        ]
+    else:
+        lines.append(f"    return cls({', '.join(args)})")
+    exec("\n".join(lines), env)
+    return env["convert"]
+
+
+def dataclass_from_row(cls: Callable[..., T], row: Optional[Row]) -> T:
     if row is None:
         return cls()
-    vals: Dict[str, Any] = {}
-    for f in dataclasses.fields(cls):
-        v: Any = row[f.name]
-        if type(v) is not f.type:
-            if f.type is datetime.datetime:
-                v = datetime.datetime.fromtimestamp(v)
-            elif f.type is datetime.date:
-                v = datetime.date.fromisoformat(v)
-            else:
-                v = f.type(v)
-        vals[f.name] = v
-    return cls(**vals)
-
-
-def _db_json_encoder(v: Any) -> Any:
+    return row_converter(cls)(row)
+
+
+def dataclasses_from_rows(
+    cls: Callable[..., T], rows: Iterable[Row]
+) -> List[T]:
+    convert = row_converter(cls)
+    return [convert(row) for row in rows]
+
+
+def adopt_value_for_db(v: Any) -> Any:
     if type(v) is datetime.datetime:
         return int(v.timestamp())
     if type(v) is datetime.date:
@@ -35,4 +87,4 @@ def _db_json_encoder(v: Any) -> Any:
 
 
 def adopt_json_for_db(src: Any) -> str:
-    return json.dumps(src, default=_db_json_encoder)
+    return json.dumps(src, default=adopt_value_for_db)
@@ -0,0 +1,70 @@
+import datetime
+import logging
+import time
+from typing import Iterable, List, Optional
+
+from eve import market, world
+
+
+class Refresher:
+    """Keeps stored prices for a watch set fresh in the background.
+
+    Each cycle refreshes every watched item once, stalest first, with the
+    requests spread evenly over the freshness window so ESI sees a steady
+    trickle instead of bursts. The watch set is recorded in the store and
+    a heartbeat is written after every item, so interactive commands know
+    which stored prices they can trust.
+    """
+
+    def __init__(
+        self,
+        ipc: market.ItemPriceCache,
+        items: Iterable[world.ItemType],
+        window: datetime.timedelta = market.FRESHNESS_WINDOW,
+    ):
+        self.ipc = ipc
+        self.items = list({it.id: it for it in items}.values())
+        self.window = window
+
+    def _stalest_first(self) -> List[world.ItemType]:
+        refreshed = dict(
+            self.ipc.conn.execute(
+                "SELECT type_id, last_refreshed FROM eveMarket "
+                "WHERE region_id = ? AND location_id = ?",
+                (self.ipc.region_id, self.ipc.location_id),
+            )
+        )
+        return sorted(self.items, key=lambda it: refreshed.get(it.id, 0))
+
+    def run_cycle(self):
+        items = self._stalest_first()
+        # Leave some slack so a cycle finishes before its items go stale.
+        slot = 0.9 * self.window.total_seconds() / max(len(items), 1)
+        logging.info("refreshing %d items, one every %.1fs", len(items), slot)
+        start = time.monotonic()
+        for i, it in enumerate(items):
+            try:
+                self.ipc.refresh(it)
+            except Exception:
+                logging.exception("failed to refresh %s", it.name)
+            next_slot = start + (i + 1) * slot
+            with self.ipc.store.writer() as conn:
+                market.record_refresher_heartbeat(
+                    conn,
+                    datetime.datetime.now()
+                    + datetime.timedelta(seconds=next_slot - time.monotonic()),
+                )
+            time.sleep(max(0.0, next_slot - time.monotonic()))
+
+    def run(self, cycles: Optional[int] = None):
+        with self.ipc.store.writer() as conn:
+            market.record_refresher_items(
+                conn,
+                self.ipc.region_id,
+                self.ipc.location_id,
+                (it.id for it in self.items),
+            )
+        done = 0
+        while cycles is None or done < cycles:
+            self.run_cycle()
+            done += 1
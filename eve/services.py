@@ -1,37 +1,112 @@
+import datetime
 import functools
+import json
 import logging
 import os
 import sqlite3
+import urllib.error
+import urllib.request
+from typing import TYPE_CHECKING, Any, Dict
 
-from bravado.client import SwaggerClient
+from eve import db
+
+if TYPE_CHECKING:
+    from bravado.client import SwaggerClient
 
 REFERENCE_DB_FILE_NAME = "../data/reference.sqlite"
 STORE_DB_FILE_NAME = "../data/db.sqlite"
+SWAGGER_CACHE_FILE_NAME = "../data/swagger.json"
+MARKET_ARCHIVE_DIR_NAME = "../data/market_archive"
+
+SWAGGER_URL = (
+    "https://esi.evetech.net/latest/swagger.json?datasource=tranquility"
+)
+SWAGGER_MAX_AGE = datetime.timedelta(days=1)
+
+
+def _data_path(file_name: str) -> str:
+    return os.path.join(os.path.dirname(__file__), file_name)
+
+
+def _download_swagger_spec(etag: str) -> Dict[str, Any]:
+    request = urllib.request.Request(SWAGGER_URL)
+    if etag:
+        request.add_header("If-None-Match", etag)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return {
+                "etag": response.headers.get("ETag", ""),
+                "spec": json.load(response),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return {}
+        raise
+
+
+def load_swagger_spec() -> Dict[str, Any]:
+    path = _data_path(SWAGGER_CACHE_FILE_NAME)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cached = {}
+    now = datetime.datetime.now()
+    fetched = datetime.datetime.fromtimestamp(cached.get("fetched", 0))
+    if cached and now - fetched <= SWAGGER_MAX_AGE:
+        return cached["spec"]
+    logging.info("refreshing EVE API spec")
+    try:
+        downloaded = _download_swagger_spec(cached.get("etag", ""))
+    except OSError:
+        if not cached:
+            raise
+        logging.warning("can't refresh EVE API spec, using cached copy")
+        return cached["spec"]
+    if downloaded:
+        cached = downloaded
+        logging.info(
+            "EVE API spec version %s", cached["spec"]["info"]["version"]
+        )
+    cached["fetched"] = int(now.timestamp())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cached, f)
+    os.replace(tmp_path, path)
+    return cached["spec"]
 
 
 class Services:
     @functools.cached_property
-    def api(self) -> SwaggerClient:
+    def api(self) -> "SwaggerClient":
+        # bravado takes a while to import, so only load it when needed.
+        from bravado.client import SwaggerClient
+
         logging.info("initializing connection to EVE server")
-        api = SwaggerClient.from_url(
-            "https://esi.evetech.net/latest/swagger.json?datasource=tranquility",
-            config={"use_models": False},
+        api = SwaggerClient.from_spec(
+            load_swagger_spec(),
+            origin_url=SWAGGER_URL,
+            config={"use_models": False, "validate_swagger_spec": False},
         )
         logging.info("EVE API initialized")
         return api
 
+    @property
+    def reference_db_path(self) -> str:
+        return _data_path(REFERENCE_DB_FILE_NAME)
+
+    @property
+    def market_archive_path(self) -> str:
+        return _data_path(MARKET_ARCHIVE_DIR_NAME)
+
     @functools.cached_property
     def reference_db(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(
-            os.path.join(os.path.dirname(__file__), REFERENCE_DB_FILE_NAME)
-        )
-        conn.row_factory = sqlite3.Row
-        return conn
+        return db.connect_reference(self.reference_db_path)
 
     @functools.cached_property
+    def store(self) -> db.ConnectionPool:
+        return db.ConnectionPool(_data_path(STORE_DB_FILE_NAME))
+
+    @property
     def store_db(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(
-            os.path.join(os.path.dirname(__file__), STORE_DB_FILE_NAME)
-        )
-        conn.row_factory = sqlite3.Row
-        return conn
+        return self.store.reader()
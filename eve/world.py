@@ -1,6 +1,7 @@
+import collections
 import dataclasses
 import sqlite3
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from eve.orm_util import dataclass_from_row
 
@@ -42,6 +43,8 @@ JITA_4_4_STATION_ID = 60003760
 INDUSTRY_ACTIVITY_MANUFACTURING = 1
 INDUSTRY_ACTIVITY_INVENTION = 8
 INDUSTRY_ACTIVITY_REACTIONS = 11
+# "Test Reaction", which isn't a real formula.
+TEST_REACTION_BLUEPRINT_ID = 45732
 
 UNKNOWN_NAME = "<unknown>"
 MAX_VALID_STATION_ID = 100000000
@@ -139,9 +142,120 @@ class FormulaNotFound(LookupError):
     pass
 
 
+@dataclasses.dataclass(frozen=True)
+class FormulaIndex:
+    # Manufacturing and reaction formulas by blueprint id.
+    by_blueprint: Dict[int, Formula]
+    # Product id to the blueprint find_blueprint() picks for it.
+    blueprint_by_product: Dict[int, int]
+    # Material id to the blueprints consuming it.
+    consumers: Dict[int, List[int]]
+
+
 class World:
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self, conn: sqlite3.Connection, preload: bool = False):
         self.conn = conn
+        self._types_by_id: Optional[Dict[int, ItemType]] = None
+        self._types_by_name: Dict[str, ItemType] = {}
+        self._formula_index: Optional[FormulaIndex] = None
+        if preload:
+            self.load_index()
+
+    def load_index(self):
+        categories: Dict[int, str] = dict(
+            self.conn.execute(
+                "SELECT categoryID, categoryName FROM invCategories"
+            ).fetchall()
+        )
+        groups: Dict[int, Tuple[str, str]] = {}
+        for group_id, group_name, category_id in self.conn.execute(
+            "SELECT groupID, groupName, categoryID FROM invGroups"
+        ):
+            if category_id in categories:
+                groups[group_id] = (group_name, categories[category_id])
+        types_by_id: Dict[int, ItemType] = {}
+        types_by_name: Dict[str, ItemType] = {}
+        for type_id, name, group_id, volume in self.conn.execute(
+            "SELECT typeID, typeName, groupID, volume FROM invTypes"
+        ):
+            if group_id not in groups:
+                continue
+            group, category = groups[group_id]
+            it = ItemType(type_id, name, group, category, float(volume or 0))
+            types_by_id[type_id] = it
+            types_by_name.setdefault(name, it)
+        self._types_by_id = types_by_id
+        self._types_by_name = types_by_name
+
+    def load_formula_index(self) -> FormulaIndex:
+        """Reads every manufacturing and reaction formula in three queries.
+
+        Afterwards find_formula(), find_blueprint() and find_material_uses()
+        are answered from memory.
+        """
+        if self._types_by_id is None:
+            self.load_index()
+        activities = (
+            INDUSTRY_ACTIVITY_MANUFACTURING,
+            INDUSTRY_ACTIVITY_REACTIONS,
+        )
+        # Rows are kept in table order so that where a query would take
+        # the first match, so does the index.
+        times: Dict[Tuple[int, int], float] = {}
+        for type_id, activity_id, time in self.conn.execute(
+            "SELECT typeID, activityID, time FROM industryActivity "
+            "WHERE activityID IN (?, ?)",
+            activities,
+        ):
+            times.setdefault((type_id, activity_id), time)
+        outputs: Dict[Tuple[int, int], Tuple[int, float]] = {}
+        blueprint_by_product: Dict[int, int] = {}
+        for type_id, activity_id, product_id, quantity in self.conn.execute(
+            "SELECT typeID, activityID, productTypeID, quantity "
+            "FROM industryActivityProducts WHERE activityID IN (?, ?)",
+            activities,
+        ):
+            outputs.setdefault((type_id, activity_id), (product_id, quantity))
+            if type_id != TEST_REACTION_BLUEPRINT_ID:
+                blueprint_by_product.setdefault(product_id, type_id)
+        inputs: Dict[
+            Tuple[int, int], List[ItemQuantity]
+        ] = collections.defaultdict(list)
+        consumers: Dict[int, Dict[int, None]] = collections.defaultdict(dict)
+        for type_id, activity_id, material_id, quantity in self.conn.execute(
+            "SELECT typeID, activityID, materialTypeID, quantity "
+            "FROM industryActivityMaterials WHERE activityID IN (?, ?)",
+            activities,
+        ):
+            inputs[type_id, activity_id].append(
+                ItemQuantity(self.find_item_type(material_id), quantity)
+            )
+            if type_id != TEST_REACTION_BLUEPRINT_ID:
+                consumers[material_id][type_id] = None
+        by_blueprint: Dict[int, Formula] = {}
+        for (type_id, activity_id), time in times.items():
+            blueprint = self.find_item_type(type_id)
+            if not blueprint.is_blueprint or activity_id != (
+                INDUSTRY_ACTIVITY_REACTIONS
+                if blueprint.is_reaction_blueprint
+                else INDUSTRY_ACTIVITY_MANUFACTURING
+            ):
+                continue
+            if (type_id, activity_id) not in outputs:
+                continue
+            product_id, quantity = outputs[type_id, activity_id]
+            by_blueprint[type_id] = Formula(
+                blueprint,
+                time,
+                ItemQuantity(self.find_item_type(product_id), quantity),
+                inputs.get((type_id, activity_id), []),
+            )
+        self._formula_index = FormulaIndex(
+            by_blueprint,
+            blueprint_by_product,
+            {id: list(bps) for id, bps in consumers.items()},
+        )
+        return self._formula_index
 
     def find_station(self, station_id: int) -> Station:
         if station_id > MAX_VALID_STATION_ID:
@@ -155,6 +269,8 @@ class World:
         return dataclass_from_row(Station, cursor.fetchone())
 
     def find_item_type(self, type_id: int) -> ItemType:
+        if self._types_by_id is not None:
+            return self._types_by_id.get(type_id) or ItemType()
         cursor = self.conn.execute(
             "SELECT "
             "  T.typeID id, T.typeName name, G.groupName 'group', "
@@ -167,6 +283,10 @@ class World:
         return dataclass_from_row(ItemType, cursor.fetchone())
 
     def find_item_type_by_name(self, name: str) -> ItemType:
+        if self._types_by_id is not None:
+            if name not in self._types_by_name:
+                raise ValueError(f"item type '{name}' not found")
+            return self._types_by_name[name]
         row = self.conn.execute(
             "SELECT "
             "  T.typeID id, T.typeName name, G.groupName 'group', "
@@ -181,14 +301,18 @@ class World:
         return dataclass_from_row(ItemType, row)
 
     def find_blueprint(self, item: ItemType) -> Optional[ItemType]:
+        if self._formula_index is not None:
+            bp_id = self._formula_index.blueprint_by_product.get(item.id)
+            return None if bp_id is None else self.find_item_type(bp_id)
         row = self.conn.execute(
             "SELECT typeID FROM industryActivityProducts "
             "WHERE productTypeID = ? AND activityID IN (?, ?) "
-            "  AND typeID != 45732",  # "Test Reaction".
+            "  AND typeID != ?",
             (
                 item.id,
                 INDUSTRY_ACTIVITY_MANUFACTURING,
                 INDUSTRY_ACTIVITY_REACTIONS,
+                TEST_REACTION_BLUEPRINT_ID,
             ),
         ).fetchone()
         if not row:
@@ -196,14 +320,22 @@ class World:
         return self.find_item_type(row[0])
 
     def find_material_uses(self, mat: ItemType) -> List[Formula]:
+        if self._formula_index is not None:
+            index = self._formula_index
+            return [
+                index.by_blueprint[bpid]
+                for bpid in index.consumers.get(mat.id, [])
+                if bpid in index.by_blueprint
+            ]
         cursor = self.conn.execute(
             "SELECT typeID FROM industryActivityMaterials "
             "WHERE materialTypeID = ? AND activityID IN (?, ?) "
-            "  AND typeID != 45732",  # "Test Reaction".
+            "  AND typeID != ?",
             (
                 mat.id,
                 INDUSTRY_ACTIVITY_MANUFACTURING,
                 INDUSTRY_ACTIVITY_REACTIONS,
+                TEST_REACTION_BLUEPRINT_ID,
             ),
         )
         blueprint_ids = set(row[0] for row in cursor)
@@ -257,6 +389,11 @@ class World:
     def find_formula(self, blueprint: ItemType) -> Formula:
         if not blueprint.is_blueprint:
             raise ValueError(f"{blueprint.name} is not a blueprint")
+        if (
+            self._formula_index is not None
+            and blueprint.id in self._formula_index.by_blueprint
+        ):
+            return self._formula_index.by_blueprint[blueprint.id]
         activity_id = (
             INDUSTRY_ACTIVITY_REACTIONS
             if blueprint.is_reaction_blueprint
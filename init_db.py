@@ -1,5 +1,12 @@
-from eve import market, services
+from eve import market, order_snapshots, services
 
 def init_db():
     serv = services.Services()
-    market.create_tables(serv.store_db)
\ No newline at end of file
+    with serv.store.writer() as conn:
+        market.create_tables(conn)
+
+
+def compact_db():
+    serv = services.Services()
+    with serv.store.writer() as conn:
+        order_snapshots.compact_order_snapshots(conn)
\ No newline at end of file
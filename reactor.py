@@ -1,10 +1,38 @@
+import argparse
+import atexit
+import concurrent.futures
 import dataclasses
 import datetime
+import heapq
 import logging
 import itertools
-from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
-
-from eve import market, services, world
+import math
+import os
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import numpy as np
+
+from eve import (
+    bom,
+    esi_archive,
+    esi_async,
+    esi_scheduler,
+    formula_cache,
+    instrument,
+    market,
+    refresher as market_refresher,
+    services,
+    world,
+)
 
 REACTIONS = [
     46166,  # Caesarium Cadmide Reaction Formula
@@ -60,7 +88,7 @@ REACTIONS = [
 # Promethium
 
 ItemPriceSource = Callable[[world.ItemType], market.ItemPrice]
-ItemPriceHistoryDict = Dict[world.ItemType, List[market.HistoricalItemPrice]]
+ItemPriceHistoryDict = Dict[world.ItemType, market.PriceSeries]
 
 SYSTEM_COST_FACTOR = 0.03
 SHIPMENT_COST_PER_M3 = 200
@@ -132,6 +160,7 @@ class PricedFormula:
 SALES_TAX_DISCOUNT = 0.97
 
 
+@instrument.timed("price_formula")
 def price_formula(
     ips: ItemPriceSource, name: str, f: world.Formula, me=1.0
 ) -> PricedFormula:
@@ -163,6 +192,72 @@ def price_formula(
     )
 
 
+def profit_ratio_key(p: PricedFormula) -> float:
+    return p.profit / p.input_cost
+
+
+# Formulas and prices a pricing worker was started with. They are handed
+# over once per process, so tasks only carry index ranges.
+_worker_formulas: List[Tuple[str, world.Formula]] = []
+_worker_prices: Dict[world.ItemType, market.ItemPrice] = {}
+# Tasks per worker, so a slow shard doesn't leave the other cores idle.
+PRICING_SHARDS_PER_WORKER = 4
+
+
+def _init_pricing_worker(
+    formulas: List[Tuple[str, world.Formula]],
+    prices: Dict[world.ItemType, market.ItemPrice],
+):
+    global _worker_formulas, _worker_prices
+    # A forked worker inherits the parent's recorder, whose spans would
+    # never be reported.
+    instrument.disable()
+    _worker_formulas = formulas
+    _worker_prices = prices
+
+
+def _price_shard(
+    start: int, stop: int
+) -> List[Tuple[float, float, float, float]]:
+    r = []
+    for name, f in _worker_formulas[start:stop]:
+        p = price_formula(_worker_prices.__getitem__, name, f)
+        r.append((p.daily_volume_in_runs, p.profit, p.input_cost, p.job_cost))
+    return r
+
+
+def price_formulas(
+    prices: Dict[world.ItemType, market.ItemPrice],
+    formulas: List[Tuple[str, world.Formula]],
+    jobs: int = 1,
+    key: Callable[[PricedFormula], float] = profit_ratio_key,
+) -> List[PricedFormula]:
+    """Prices formulas on up to `jobs` processes, highest `key` first."""
+    if jobs <= 1 or len(formulas) < 2:
+        priced = [price_formula(prices.__getitem__, n, f) for n, f in formulas]
+    else:
+        shard = -(-len(formulas) // (jobs * PRICING_SHARDS_PER_WORKER))
+        starts = range(0, len(formulas), shard)
+        with concurrent.futures.ProcessPoolExecutor(
+            jobs,
+            initializer=_init_pricing_worker,
+            initargs=(formulas, prices),
+        ) as pool:
+            results = pool.map(
+                _price_shard, starts, [start + shard for start in starts]
+            )
+            # Every formula only reads its own items, so sharing the one
+            # price dict gives print() the same view price_formula() has.
+            priced = [
+                PricedFormula(name, f, *numbers, prices)
+                for (name, f), numbers in zip(
+                    formulas, itertools.chain.from_iterable(results)
+                )
+            ]
+    priced.sort(key=key, reverse=True)
+    return priced
+
+
 def fold_formula_with(
     f: world.Formula, to_fold: Dict[int, world.Formula]
 ) -> Tuple[str, world.Formula]:
@@ -183,6 +278,10 @@ def fold_formula_with(
             new_items.append(
                 world.ItemQuantity(s_it.item_type, s_it.quantity * multiplier)
             )
+        for s_it in sub_f.intermediates:
+            intermediates.append(
+                world.ItemQuantity(s_it.item_type, s_it.quantity * multiplier)
+            )
     names = [it.output.item_type.name for it in to_fold.values()]
     sub_names = "/".join(sorted(names))
     name = f"{f.output.item_type.name}[{sub_names}]"
@@ -220,24 +319,153 @@ def fold_formula(
     return r
 
 
+TOP_FOLD_PLANS = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class FoldPlan:
+    # Inputs, jobs and shipment for the runs the plan was searched for.
+    cost: float
+    # Inputs that are made rather than bought, with their own plans.
+    folds: Tuple[Tuple[int, "FoldPlan"], ...] = ()
+
+
+class FoldSearch:
+    # Finds the cheapest make-vs-buy decisions over a formula tree of any
+    # depth. The K best plans for every formula are computed once per
+    # scale and shared by all formulas consuming its output at that scale.
+    def __init__(
+        self,
+        formulas_by_output: Dict[int, world.Formula],
+        ips: ItemPriceSource,
+        k: int = TOP_FOLD_PLANS,
+        me: float = 1.0,
+    ):
+        self.formulas_by_output = formulas_by_output
+        self.ips = ips
+        self.k = k
+        self.me = me
+        self._plans: Dict[Tuple[int, float], List[FoldPlan]] = {}
+        self._in_progress: Set[int] = set()
+        # Cycle cuts so far. Plans found while this went up depend on which
+        # formula the search started from, so they aren't cached.
+        self._cuts = 0
+
+    def _input_options(
+        self, inp: world.ItemQuantity, scale: float
+    ) -> List[Tuple[float, Optional[FoldPlan]]]:
+        it = inp.item_type
+        p = self.ips(it)
+        qty = inp.quantity * scale
+        # Bought the way price_formula() charges for it: whole units after
+        # ME, plus the job share and shipment.
+        options: List[Tuple[float, Optional[FoldPlan]]] = [
+            (
+                p.high_price
+                * max(1.0, self.me * qty)
+                * (1 + SYSTEM_COST_FACTOR)
+                + qty * it.volume_m3 * SHIPMENT_COST_PER_M3,
+                None,
+            )
+        ]
+        f = self.formulas_by_output.get(it.id)
+        if f is not None and it.id in self._in_progress:
+            # (Indirectly) an input of itself, so it can only be bought.
+            self._cuts += 1
+        elif f is not None:
+            # Same costs as price_formula() charges for a folded input: a
+            # job for one full run, plus the sub-formula's inputs.
+            job_cost = (
+                SYSTEM_COST_FACTOR * p.high_price * f.output.quantity * scale
+            )
+            for plan in self.plans(f, qty / f.output.quantity):
+                options.append((job_cost + plan.cost, plan))
+            options.sort(key=lambda o: o[0])
+        return options
+
+    def plans(self, f: world.Formula, scale: float = 1.0) -> List[FoldPlan]:
+        # Inputs are rounded up to whole units, so a plan's cost isn't
+        # linear in runs and each scale gets its own search.
+        type_id = f.output.item_type.id
+        key = (type_id, scale)
+        if key in self._plans:
+            return self._plans[key]
+        cuts = self._cuts
+        self._in_progress.add(type_id)
+        tie = itertools.count()
+        partial = [FoldPlan(0.0)]
+        for inp in f.inputs:
+            options = self._input_options(inp, scale)
+            best: List[Tuple[float, int, FoldPlan]] = []
+            for p in partial:
+                # Both lists are sorted: once the cheapest option can't
+                # beat the K-th best plan, no later partial plan can.
+                if len(best) == self.k and (
+                    p.cost + options[0][0] >= -best[0][0]
+                ):
+                    break
+                for cost, sub_plan in options:
+                    cost += p.cost
+                    if len(best) == self.k and cost >= -best[0][0]:
+                        break
+                    folds = p.folds
+                    if sub_plan is not None:
+                        folds += ((inp.item_type.id, sub_plan),)
+                    entry = (-cost, next(tie), FoldPlan(cost, folds))
+                    if len(best) < self.k:
+                        heapq.heappush(best, entry)
+                    else:
+                        heapq.heapreplace(best, entry)
+            partial = sorted((e[2] for e in best), key=lambda p: p.cost)
+        self._in_progress.discard(type_id)
+        if self._cuts == cuts:
+            self._plans[key] = partial
+        return partial
+
+    def apply(self, f: world.Formula, plan: FoldPlan) -> world.Formula:
+        to_fold = {
+            type_id: self.apply(self.formulas_by_output[type_id], sub)
+            for type_id, sub in plan.folds
+        }
+        return fold_formula_with(f, to_fold)[1]
+
+    def plan_name(self, f: world.Formula, plan: FoldPlan) -> str:
+        if not plan.folds:
+            return f.output.item_type.name
+        names = [
+            self.plan_name(self.formulas_by_output[type_id], sub)
+            for type_id, sub in plan.folds
+        ]
+        return f"{f.output.item_type.name}[{'/'.join(sorted(names))}]"
+
+    @instrument.timed("fold_search")
+    def best_folds(self, f: world.Formula) -> List[Tuple[str, world.Formula]]:
+        return [
+            (self.plan_name(f, p), self.apply(f, p)) for p in self.plans(f)
+        ]
+
+
 def date_to_datetime(d: datetime.date) -> datetime.datetime:
     return datetime.datetime(d.year, d.month, d.day)
 
 
-def print_industry_tree(w: world.World, padding: int, it: world.ItemType):
-    bp = w.find_blueprint(it)
-    if not bp:
+def print_industry_tree(
+    b: bom.BillOfMaterials, padding: int, it: world.ItemType
+):
+    f = b.find_formula(it)
+    if not f:
         return
-    f = w.find_formula(bp)
+    bp = f.blueprint
 
     print(" " * padding + f"{f.output.quantity}x {it.name} ({bp.group})")
     for inp in f.inputs:
         print(" " * padding + f"- {inp.quantity}x {inp.item_type.name}")
 
     for inp in f.inputs:
-        print_industry_tree(w, padding + 2, inp.item_type)
+        print_industry_tree(b, padding + 2, inp.item_type)
 
 
+@instrument.timed("fold_all_formulas")
 def fold_all_formulas(
     formulas: List[world.Formula], only_full_folds=False
 ) -> List[Tuple[str, world.Formula]]:
@@ -253,15 +481,126 @@ def get_all_items(formulas: List[world.Formula]) -> Set[world.ItemType]:
     for f in formulas:
         r.add(f.output.item_type)
         r.update(it.item_type for it in f.inputs)
+        r.update(it.item_type for it in f.intermediates)
     return r
 
 
+# Manufactured items whose inputs and outputs are kept fresh by refresher().
+WATCHED_ITEMS = [
+    # Weapons
+    "Rapid Light Missile Launcher II",
+    "720mm Howitzer Artillery II",
+    "Heavy Missile Launcher II",
+    "Heavy Assault Missile Launcher II",
+    "Mega Pulse Laser II",
+    "425mm AutoCannon II",
+    "Small Focused Beam Laser II",
+    # Drones
+    "Warrior II",
+    "Acolyte II",
+    "Hornet II",
+    "Hobgoblin II",
+    "Hammerhead II",
+    "Infiltrator II",
+    "Valkyrie II",
+    "Ogre II",
+    # Tank
+    "Large Shield Extender II",
+    "Medium Shield Extender II",
+    "Multispectrum Shield Hardener II",
+    "Large Shield Booster II",
+    "Nanofiber Internal Structure II",
+    "Damage Control II",
+    "Assault Damage Control II",
+    "Medium Armor Repairer II",
+    "Multispectrum Energized Membrane II",
+    "Shield Power Relay II",
+    # Eng. and misc
+    "Co-Processor II",
+    "Warp Disruptor II",
+    "Stasis Webifier II",
+    "Warp Scrambler II",
+    "Medium Capacitor Booster II",
+    # Damage mods
+    "Drone Damage Amplifier II",
+    "Heat Sink II",
+    "Gyrostabilizer II",
+    "Ballistic Control System II",
+    "Magnetic Field Stabilizer II",
+    "Tracking Enhancer II",
+    # Rigs
+    "Medium Core Defense Field Purger I",
+    "Medium Core Defense Field Purger II",
+    "Medium Core Defense Field Extender II",
+    "Medium EM Shield Reinforcer II",
+    "Medium Thermal Shield Reinforcer II",
+    "Medium Hydraulic Bay Thrusters II",
+    "Medium Rocket Fuel Cache Partition II",
+    "Medium Energy Locus Coordinator II",
+    "Medium Hyperspatial Velocity Optimizer II",
+    "Small Energy Locus Coordinator II",
+    # Fuel
+    "Helium Fuel Block",
+    "Hydrogen Fuel Block",
+    "Nitrogen Fuel Block",
+    "Oxygen Fuel Block",
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class ReactionGraph:
+    formulas: List[world.Formula]
+    full_folds: List[Tuple[str, world.Formula]]
+    items: Set[world.ItemType]
+    formulas_by_output: Dict[int, world.Formula]
+    formulas_by_output_name: Dict[str, world.Formula]
+
+
+def build_reaction_graph(w: world.World) -> ReactionGraph:
+    formulas = [w.find_formula(w.find_item_type(id)) for id in REACTIONS]
+    return ReactionGraph(
+        formulas,
+        fold_all_formulas(formulas, only_full_folds=True),
+        get_all_items(formulas),
+        {f.output.item_type.id: f for f in formulas},
+        {f.output.item_type.name: f for f in formulas},
+    )
+
+
+def load_reaction_graph(
+    serv: services.Services, w: world.World
+) -> ReactionGraph:
+    return formula_cache.load_or_build(
+        "reactions",
+        (
+            formula_cache.reference_db_key(serv.reference_db_path),
+            tuple(REACTIONS),
+        ),
+        lambda: build_reaction_graph(w),
+    )
+
+
+def load_material_uses(
+    serv: services.Services, w: world.World, material: str
+) -> List[world.Formula]:
+    def build() -> List[world.Formula]:
+        w.load_index()
+        return w.find_material_uses(w.find_item_type_by_name(material))
+
+    return formula_cache.load_or_build(
+        f"material-uses-{material}",
+        formula_cache.reference_db_key(serv.reference_db_path),
+        build,
+    )
+
+
 def get_all_price_histories(
     ipc: market.ItemPriceCache, items: Iterable[world.ItemType]
 ) -> ItemPriceHistoryDict:
-    return {it: ipc.get_price_history(it) for it in items}
+    return ipc.get_price_histories(items)
 
 
+@instrument.timed("get_price_snapshot")
 def get_price_snapshot(
     hist: ItemPriceHistoryDict, d: datetime.date
 ) -> ItemPriceSource:
@@ -270,53 +609,253 @@ def get_price_snapshot(
     min_date = d - time_radius
     max_date = d + time_radius
     for it, prices in hist.items():
-        r[it] = get_mean_price(
-            it.id,
-            [p for p in prices if p.date >= min_date and p.date <= max_date],
-        )
+        r[it] = get_mean_price(it.id, prices.between(min_date, max_date))
     return lambda it: r[it]
 
 
-def get_mean_price(
-    type_id, slice: List[market.HistoricalItemPrice]
-) -> market.ItemPrice:
-    volume_sum = sum(p.volume for p in slice)
-    price = sum(p.volume * p.average for p in slice) / volume_sum
+MEAN_PRICE_SELL_FACTOR = 0.96  # Assumes 4% overhead of sell orders
+MEAN_PRICE_BUY_FACTOR = 1.02  # Assumes 2% overhead of buy orders
+
+
+def get_mean_price(type_id, slice: market.PriceSeries) -> market.ItemPrice:
+    volume_sum = float(slice.volume.sum())
+    price = slice.vwap()
 
     return market.ItemPrice(
         type_id=type_id,
-        last_refreshed=date_to_datetime(slice[-1].date),
+        last_refreshed=date_to_datetime(slice.dates[-1].item()),
         daily_trade_volume=(volume_sum / len(slice)),
-        low_price=(price * 0.96),  # Assumes 4% overhead of sell orders
-        high_price=(price * 1.02),  # Assumes 2% overhead of buy orders
+        low_price=(price * MEAN_PRICE_SELL_FACTOR),
+        high_price=(price * MEAN_PRICE_BUY_FACTOR),
     )
 
 
 def get_common_dates(prices: ItemPriceHistoryDict) -> List[datetime.date]:
     r = None
-    for price_list in prices.values():
+    for series in prices.values():
         if r is None:
-            r = set(p.date for p in price_list)
+            r = series.dates
         else:
-            r = r.intersection(p.date for p in price_list)
+            r = np.intersect1d(r, series.dates, assume_unique=True)
     if r is None:
         return []
-    return sorted(r)
+    return r.tolist()
 
 
 def profit_key(xs: List[float]) -> Any:
     return (sum(bool(x > 0.1) for x in xs), sum(xs))
 
 
+@dataclasses.dataclass(frozen=True)
+class PriceMatrix:
+    items: Dict[world.ItemType, int]
+    dates: List[datetime.date]
+    # items x dates, same values get_price_snapshot() would produce.
+    price: np.ndarray
+    volume: np.ndarray
+
+
+@instrument.timed("build_price_matrix")
+def build_price_matrix(
+    hist: ItemPriceHistoryDict, dates: List[datetime.date]
+) -> PriceMatrix:
+    items = {it: i for i, it in enumerate(hist)}
+    shape = (len(items), len(dates))
+    volume_sum = np.zeros(shape)
+    cost_sum = np.zeros(shape)
+    days = np.zeros(shape)
+    date_arr = np.array(dates, dtype="datetime64[D]")
+    order = np.argsort(date_arr)
+    for it, prices in hist.items():
+        if not dates:
+            break
+        row = items[it]
+        pos = np.searchsorted(date_arr, prices.dates, sorter=order)
+        cols = order[np.minimum(pos, len(dates) - 1)]
+        found = date_arr[cols] == prices.dates
+        cols = cols[found]
+        np.add.at(volume_sum[row], cols, prices.volume[found])
+        np.add.at(
+            cost_sum[row], cols, prices.volume[found] * prices.average[found]
+        )
+        np.add.at(days[row], cols, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return PriceMatrix(
+            items, dates, cost_sum / volume_sum, volume_sum / days
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class CompiledFormulas:
+    names: List[str]
+    output_idx: np.ndarray
+    output_qty: np.ndarray
+    # Formulas x slots; unused slots point at item 0 with zero quantity.
+    input_idx: np.ndarray
+    input_qty: np.ndarray
+    intermediate_idx: np.ndarray
+    intermediate_qty: np.ndarray
+    m3: np.ndarray
+
+
+def compile_formulas(
+    formulas: List[Tuple[str, world.Formula]],
+    items: Dict[world.ItemType, int],
+    me=1.0,
+) -> CompiledFormulas:
+    n = len(formulas)
+    n_inputs = max((len(f.inputs) for _, f in formulas), default=0)
+    n_intermediates = max(
+        (len(f.intermediates) for _, f in formulas), default=0
+    )
+    output_idx = np.zeros(n, dtype=np.intp)
+    output_qty = np.zeros(n)
+    input_idx = np.zeros((n, n_inputs), dtype=np.intp)
+    input_qty = np.zeros((n, n_inputs))
+    intermediate_idx = np.zeros((n, n_intermediates), dtype=np.intp)
+    intermediate_qty = np.zeros((n, n_intermediates))
+    m3 = np.zeros(n)
+    for i, (_, f) in enumerate(formulas):
+        output_idx[i] = items[f.output.item_type]
+        output_qty[i] = f.output.quantity
+        total_m3 = f.output.quantity * f.output.item_type.volume_m3
+        for j, inp in enumerate(f.inputs):
+            input_idx[i, j] = items[inp.item_type]
+            input_qty[i, j] = max(1.0, me * inp.quantity)
+            total_m3 += inp.quantity * inp.item_type.volume_m3
+        for j, it in enumerate(f.intermediates):
+            intermediate_idx[i, j] = items[it.item_type]
+            intermediate_qty[i, j] = it.quantity
+        m3[i] = total_m3
+    return CompiledFormulas(
+        [name for name, _ in formulas],
+        output_idx,
+        output_qty,
+        input_idx,
+        input_qty,
+        intermediate_idx,
+        intermediate_qty,
+        m3,
+    )
+
+
+@instrument.timed("backtest_formulas")
+def backtest_formulas(
+    pm: PriceMatrix, cf: CompiledFormulas
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Mirrors price_formula() operation by operation, summing inputs in
+    # the same order, so results are bit-for-bit identical to it.
+    low = pm.price * MEAN_PRICE_SELL_FACTOR
+    high = pm.price * MEAN_PRICE_BUY_FACTOR
+    total = low[cf.output_idx] * cf.output_qty[:, None] * SALES_TAX_DISCOUNT
+    input_amt = np.zeros_like(total)
+    for j in range(cf.input_idx.shape[1]):
+        input_amt += high[cf.input_idx[:, j]] * cf.input_qty[:, j, None]
+    job_cost = input_amt * SYSTEM_COST_FACTOR
+    for j in range(cf.intermediate_idx.shape[1]):
+        job_cost += SYSTEM_COST_FACTOR * (
+            high[cf.intermediate_idx[:, j]] * cf.intermediate_qty[:, j, None]
+        )
+    total -= input_amt
+    total -= (cf.m3 * SHIPMENT_COST_PER_M3)[:, None]
+    total -= job_cost
+    return total, total / input_amt
+
+
+def parse_args(
+    add_arguments: Optional[Callable[[argparse.ArgumentParser], None]] = None
+) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--async-fetch",
+        action="store_true",
+        help="fetch market data on an asyncio event loop",
+    )
+    parser.add_argument(
+        "--market",
+        choices=["live", "offline", "record", "replay"],
+        default="live",
+        help="where market data comes from: ESI, only the store, ESI "
+        "saving every response to --archive, or only --archive",
+    )
+    parser.add_argument(
+        "--archive",
+        help="directory of recorded ESI market responses, "
+        "data/market_archive by default",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="price formulas on this many processes, 0 for one per core",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="table",
+        choices=["table", "json", "chrome"],
+        help="time ESI, SQL, parsing, folding and pricing and report it "
+        "on exit as a table, a JSON summary or a Chrome trace",
+    )
+    parser.add_argument(
+        "--profile-out",
+        default="-",
+        help="file for the --profile report, stdout by default",
+    )
+    if add_arguments:
+        add_arguments(parser)
+    args = parser.parse_args()
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    if args.profile:
+        recorder = instrument.enable()
+        atexit.register(
+            instrument.write_report, recorder, args.profile, args.profile_out
+        )
+    return args
+
+
+def make_item_price_cache(
+    serv: services.Services, args: argparse.Namespace, **kwargs
+) -> market.ItemPriceCache:
+    store = serv.store
+    if args.async_fetch:
+        fetcher: market.MarketFetcher = esi_async.AsyncFetcher()
+    else:
+        fetcher = market.ThreadedFetcher(lambda: serv.api)
+    archive = args.archive or serv.market_archive_path
+    if args.market in ("live", "record"):
+        # Every process talking to ESI shares its error budget, and a
+        # running refresher holds back while this one is interactive.
+        esi_scheduler.default_scheduler.share(serv.store)
+    if args.market == "offline":
+        kwargs["offline"] = True
+    elif args.market == "record":
+        store = esi_archive.open_store(archive)
+        fetcher = esi_archive.RecordingFetcher(fetcher, archive)
+        kwargs["trust_refresher"] = False
+    elif args.market == "replay":
+        store = esi_archive.open_store(archive)
+        fetcher = esi_archive.ReplayFetcher(archive)
+        # Recorded responses already hold the orders a snapshot would give.
+        kwargs["use_order_snapshot"] = False
+        kwargs["trust_refresher"] = False
+    return market.ItemPriceCache(
+        store, lambda: serv.api, fetcher=fetcher, **kwargs
+    )
+
+
 def history():
+    args = parse_args()
     logging.basicConfig(level=logging.INFO)
     serv = services.Services()
     w = world.World(serv.reference_db)
-    ipc = market.ItemPriceCache(serv.store_db, serv.api)
+    ipc = make_item_price_cache(serv, args)
 
-    formulas = [w.find_formula(w.find_item_type(id)) for id in REACTIONS]
-    prices = get_all_price_histories(ipc, get_all_items(formulas))
-    all_formulas = fold_all_formulas(formulas, only_full_folds=True)
+    graph = load_reaction_graph(serv, w)
+    ipc.prefetch(graph.items)
+    prices = get_all_price_histories(ipc, graph.items)
+    all_formulas = graph.full_folds
     dates = get_common_dates(prices)
     # for it, p in prices.items():
     #     print(
@@ -325,42 +864,31 @@ def history():
     #         + ", ".join(f"{dp.average}" for dp in p if dp.date in dates)
     #     )
     # return
-    results = {name: [] for name, _ in all_formulas}
-    for d in dates:
-        price_slice = get_price_snapshot(prices, d)
-        for name, f in all_formulas:
-            pf = price_formula(price_slice, name, f)
-            results[name].append(pf.profit_ratio)
-    results = [(name, profits) for name, profits in results.items()]
+    pm = build_price_matrix(prices, dates)
+    cf = compile_formulas(all_formulas, pm.items)
+    _, profit_ratios = backtest_formulas(pm, cf)
+    results = [(name, list(r)) for name, r in zip(cf.names, profit_ratios)]
     results.sort(key=lambda x: profit_key(x[1]), reverse=True)
     for name, r in results:
         print(name + ", " + ", ".join(f"{x:.3f}" for x in r))
 
 
 def reactor():
+    args = parse_args()
     logging.basicConfig(level=logging.INFO)
     serv = services.Services()
     w = world.World(serv.reference_db)
-    ipc = market.ItemPriceCache(serv.store_db, serv.api)
-
-    formulas = [w.find_formula(w.find_item_type(id)) for id in REACTIONS]
-    formulas_by_output = {f.output.item_type.id: f for f in formulas}
-    priced = []
-    for f in formulas:
-        folded = [
-            price_formula(lambda it: ipc.find_item_price(it), name, f)
-            # price_formula(
-            #     lambda it: get_mean_price(
-            #         it.id, ipc.get_price_history(it)[-5:]
-            #     ),
-            #     name,
-            #     f,
-            # )
-            for name, f in fold_formula(f, formulas_by_output)
-        ]
-        priced.extend(folded)
-    priced.sort(key=lambda p: (p.profit / p.input_cost), reverse=True)
-    for p in priced:
+    ipc = make_item_price_cache(serv, args)
+
+    graph = load_reaction_graph(serv, w)
+    prices = ipc.find_item_prices(graph.items)
+    search = FoldSearch(graph.formulas_by_output, lambda it: prices[it])
+    folds = [
+        fold
+        for formula in graph.formulas
+        for fold in search.best_folds(formula)
+    ]
+    for p in price_formulas(prices, folds, args.jobs):
         p.print()
         print()
 
@@ -369,35 +897,38 @@ def get_formula_for_item_name(w: world.World, item: str) -> world.Formula:
     return w.find_formula(w.find_blueprint(w.find_item_type_by_name(item)))
 
 
-def name_to_formula(w: world.World, name: str) -> world.Formula:
+def name_to_formula(
+    find: Callable[[str], world.Formula], name: str
+) -> world.Formula:
     main_name = name.split("[")[0].strip()
-    main_formula = get_formula_for_item_name(w, main_name)
+    main_formula = find(main_name)
     if main_name == name:
         return main_formula
     mats_names = name[len(main_name) :].strip("[]").split("/")
-    mats = [get_formula_for_item_name(w, m) for m in mats_names]
+    mats = [find(m) for m in mats_names]
     return fold_formula_with(
         main_formula, {m.output.item_type.id: m for m in mats}
     )[1]
 
 
-def print_price_history(ph: List[market.HistoricalItemPrice]):
+def print_price_history(ph: market.PriceSeries):
     ph = ph[-15:]
-    if ph[-1].volume > 1e6:
-        print("  v:" + " ".join(f"{d.volume/1000:8,.0f}K" for d in ph))
+    if ph.volume[-1] > 1e6:
+        print("  v:" + " ".join(f"{v/1000:8,.0f}K" for v in ph.volume))
     else:
-        print("  v:" + " ".join(f"{d.volume:9,.0f}" for d in ph))
+        print("  v:" + " ".join(f"{v:9,.0f}" for v in ph.volume))
     print("=" * (10 * 15 + 3))
-    print("  h:" + " ".join(f"{d.highest:9,.0f}" for d in ph))
-    print("  a:" + " ".join(f"{d.average:9,.0f}" for d in ph))
-    print("  l:" + " ".join(f"{d.lowest:9,.0f}" for d in ph))
+    print("  h:" + " ".join(f"{x:9,.0f}" for x in ph.highest))
+    print("  a:" + " ".join(f"{x:9,.0f}" for x in ph.average))
+    print("  l:" + " ".join(f"{x:9,.0f}" for x in ph.lowest))
 
 
 def shopper():
+    args = parse_args()
     logging.basicConfig(level=logging.INFO)
     serv = services.Services()
     w = world.World(serv.reference_db)
-    ipc = market.ItemPriceCache(serv.store_db, serv.api)
+    ipc = make_item_price_cache(serv, args)
 
     # name = "Sylramic Fibers[Hexite]"
     # name = "Sylramic Fibers[Hexite/Ceramic Powder]"
@@ -409,7 +940,13 @@ def shopper():
     # name = "Fullerides[Carbon Polymers]"
     name = "Fullerides[Platinum Technite/Carbon Polymers]"
     # name = "Fullerides[Platinum Technite]"
-    f = name_to_formula(w, name)
+    graph = load_reaction_graph(serv, w)
+    f = name_to_formula(
+        lambda n: graph.formulas_by_output_name.get(n)
+        or get_formula_for_item_name(w, n),
+        name,
+    )
+    ipc.prefetch(get_all_items([f]))
 
     print(f.output.item_type.name)
     print_price_history(ipc.get_price_history(f.output.item_type))
@@ -418,14 +955,23 @@ def shopper():
     qty = 2000
     total = 0.0
     total_m3 = 0.0
+    books = ipc.get_order_books(i.item_type for i in f.inputs)
     for i in f.inputs:
         p = ipc.find_item_price(i.item_type)
-        amt = qty * i.quantity * p.high_price
+        _, sell_book = books[i.item_type]
+        # The multibuy walks the sell orders, so price it against depth.
+        n = qty * i.quantity
+        amt = sell_book.fill_cost(n)
+        if not math.isfinite(amt):
+            print(f"only {sell_book.depth:,.0f} {i.item_type.name} on sale")
+            amt = n * p.high_price
         total += amt
-        total_m3 += qty * i.quantity * i.item_type.volume_m3
+        total_m3 += n * i.item_type.volume_m3
         print(
-            f"{i.item_type.name} x{i.quantity * qty} "
-            f"buy @{p.high_price:,.0f} {amt:,.0f}"
+            f"{i.item_type.name} x{n} "
+            f"buy @{p.high_price:,.0f} "
+            f"avg {amt / n:,.0f} last {sell_book.marginal_price(n):,.0f} "
+            f"{amt:,.0f}"
         )
         print_price_history(ipc.get_price_history(i.item_type))
         print()
@@ -436,91 +982,206 @@ def shopper():
     print()
 
 
+def watched_items(
+    b: bom.BillOfMaterials, names: Iterable[str]
+) -> Set[world.ItemType]:
+    """Named products with everything made or bought to build them."""
+    r: Set[world.ItemType] = set()
+    for name in names:
+        it = b.w.find_item_type_by_name(name)
+        if b.find_formula(it) is None:
+            logging.warning("no formula for %s, not watching it", name)
+            continue
+        bill = b.explode(it)
+        r.add(it)
+        r.update(bill.materials)
+        r.update(bill.intermediates)
+    return r
+
+
+def get_watch_set(
+    serv: services.Services, w: world.World
+) -> Set[world.ItemType]:
+    b = bom.BillOfMaterials(w)
+    return load_reaction_graph(serv, w).items | watched_items(b, WATCHED_ITEMS)
+
+
+def refresher():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serv = services.Services()
+    w = world.World(serv.reference_db, preload=True)
+    ipc = make_item_price_cache(
+        serv,
+        args,
+        priority=esi_scheduler.BACKGROUND,
+        trust_refresher=False,
+    )
+    market_refresher.Refresher(ipc, get_watch_set(serv, w)).run()
+
+
+REGION_SCAN_WORKERS = 4
+
+
+def scan_regions(
+    caches: List[market.ItemPriceCache], items: Set[world.ItemType]
+) -> Dict[int, Dict[world.ItemType, market.MarketOrders]]:
+    """Orders for items in every cache's region, fetched concurrently."""
+    with concurrent.futures.ThreadPoolExecutor(REGION_SCAN_WORKERS) as pool:
+        orders = pool.map(lambda ipc: ipc.get_orders(items), caches)
+        return {ipc.region_id: o for ipc, o in zip(caches, orders)}
+
+
+def scanner():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serv = services.Services()
+    w = world.World(serv.reference_db)
+    items = get_watch_set(serv, w)
+    # Each region is cached and goes stale on its own. The refresher only
+    # keeps Jita 4-4 warm, so region-wide prices check their own freshness.
+    # MY_REGIONS lists Syndicate twice; it is fetched once.
+    caches = [
+        make_item_price_cache(
+            serv, args, region_id=region_id, location_id=market.ANY_LOCATION
+        )
+        for region_id in dict.fromkeys(world.MY_REGIONS)
+    ]
+    orders = scan_regions(caches, items)
+    for it in sorted(items, key=lambda it: it.name):
+        buy_region, (buy_location, buy_price) = max(
+            (
+                (region_id, market.best_buy_location(o[it][0]))
+                for region_id, o in orders.items()
+            ),
+            key=lambda r: r[1][1],
+        )
+        sell_region, (sell_location, sell_price) = min(
+            (
+                (region_id, market.best_sell_location(o[it][1]))
+                for region_id, o in orders.items()
+            ),
+            key=lambda r: r[1][1],
+        )
+        print(it.name)
+        if buy_location != market.ANY_LOCATION:
+            print(
+                f"  sell to {w.find_station(buy_location).name} "
+                f"({buy_region}) @{buy_price:,.2f}"
+            )
+        if sell_location != market.ANY_LOCATION:
+            print(
+                f"  buy from {w.find_station(sell_location).name} "
+                f"({sell_region}) @{sell_price:,.2f}"
+            )
+
+
+def add_universe_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--kind",
+        choices=["all", "ships", "other"],
+        default="all",
+        help="rank only ships or only everything else",
+    )
+    parser.add_argument(
+        "--capitals", action="store_true", help="include capital items"
+    )
+    parser.add_argument(
+        "--huge",
+        action="store_true",
+        help="include capitals, structures and other huge items",
+    )
+    parser.add_argument(
+        "--uses", metavar="MATERIAL", help="only products made from this"
+    )
+    parser.add_argument("--top", type=int, default=100)
+
+
+def universe_filter(
+    args: argparse.Namespace,
+) -> Callable[[world.ItemType], bool]:
+    def keep(it: world.ItemType) -> bool:
+        if args.kind != "all" and it.is_ship != (args.kind == "ships"):
+            return False
+        if it.is_capital:
+            return args.capitals or args.huge
+        return args.huge or not it.is_huge
+
+    return keep
+
+
+def universe():
+    args = parse_args(add_universe_arguments)
+    logging.basicConfig(level=logging.INFO)
+    serv = services.Services()
+    w = world.World(serv.reference_db)
+    with instrument.span("formula index"):
+        index = w.load_formula_index()
+    if args.uses:
+        formulas = w.find_material_uses(w.find_item_type_by_name(args.uses))
+    else:
+        formulas = [
+            index.by_blueprint[bp_id]
+            for bp_id in index.blueprint_by_product.values()
+            if bp_id in index.by_blueprint
+        ]
+    keep = universe_filter(args)
+    formulas = [
+        f
+        for f in formulas
+        if keep(f.output.item_type)
+        # Materials missing from invTypes have no market to price them.
+        and all(i.item_type.id != -1 for i in f.inputs)
+    ]
+    logging.info("ranking %d products", len(formulas))
+    ipc = make_item_price_cache(serv, args)
+    prices = ipc.find_item_prices(get_all_items(formulas))
+    priced = price_formulas(
+        prices,
+        [(f.output.item_type.name, f) for f in formulas],
+        args.jobs,
+        key=lambda p: p.profit_per_day,
+    )
+    # Items nobody trades come out infinitely expensive or worthless.
+    priced = [
+        p for p in priced if math.isfinite(p.profit) and p.input_cost > 0
+    ]
+    for p in priced[: args.top]:
+        print(
+            f"{p.profit_per_day:15,.0f}/day {p.profit_ratio * 100:6.1f}% "
+            f"{p.daily_volume_in_runs:10,.1f} runs/day  {p.name}"
+        )
+
+
 def test():
+    args = parse_args()
     logging.basicConfig(level=logging.INFO)
     serv = services.Services()
     w = world.World(serv.reference_db)
-    ipc = market.ItemPriceCache(serv.store_db, serv.api)
+    ipc = make_item_price_cache(serv, args, use_order_snapshot=True)
     # Direct list of items
-    items = [
-        # Weapons
-        "Rapid Light Missile Launcher II",
-        "720mm Howitzer Artillery II",
-        "Heavy Missile Launcher II",
-        "Heavy Assault Missile Launcher II",
-        "Mega Pulse Laser II",
-        "425mm AutoCannon II",
-        "Small Focused Beam Laser II",
-        # Drones
-        "Warrior II",
-        "Acolyte II",
-        "Hornet II",
-        "Hobgoblin II",
-        "Hammerhead II",
-        "Infiltrator II",
-        "Valkyrie II",
-        "Ogre II",
-        # Tank
-        "Large Shield Extender II",
-        "Medium Shield Extender II",
-        "Multispectrum Shield Hardener II",
-        "Large Shield Booster II",
-        "Nanofiber Internal Structure II",
-        "Damage Control II",
-        "Assault Damage Control II",
-        "Medium Armor Repairer II",
-        "Multispectrum Energized Membrane II",
-        "Shield Power Relay II",
-        # Eng. and misc
-        "Co-Processor II",
-        "Warp Disruptor II",
-        "Stasis Webifier II",
-        "Warp Scrambler II",
-        "Medium Capacitor Booster II",
-        # Damage mods
-        "Drone Damage Amplifier II",
-        "Heat Sink II",
-        "Gyrostabilizer II",
-        "Ballistic Control System II",
-        "Magnetic Field Stabilizer II",
-        "Tracking Enhancer II",
-        # Rigs
-        "Medium Core Defense Field Purger I",
-        "Medium Core Defense Field Purger II",
-        "Medium Core Defense Field Extender II",
-        "Medium EM Shield Reinforcer II",
-        "Medium Thermal Shield Reinforcer II",
-        "Medium Hydraulic Bay Thrusters II",
-        "Medium Rocket Fuel Cache Partition II",
-        "Medium Energy Locus Coordinator II",
-        "Medium Hyperspatial Velocity Optimizer II",
-        "Small Energy Locus Coordinator II",
-        # Fuel
-        "Helium Fuel Block",
-        "Hydrogen Fuel Block",
-        "Nitrogen Fuel Block",
-        "Oxygen Fuel Block",
-    ]
+    items = WATCHED_ITEMS
 
     # Formulas for items assuming T2 BP exists
     # fs = [get_formula_for_item_name(w, item) for item in items]
     # All formulas that use a material
-    mat = w.find_item_type_by_name("Sylramic Fibers")
-    fs = w.find_material_uses(mat)
+    fs = load_material_uses(serv, w, "Sylramic Fibers")
     fs = [f for f in fs if not f.output.item_type.is_capital]
+    named = [(f.output.item_type.name, f) for f in fs]
+    # Also priced from raw materials, building every component in-house.
+    # The formulas share most of their components, which are exploded once.
+    b = bom.BillOfMaterials(w)
+    named += [
+        (f"{name} (from raw)", b.explode_formula(f)) for name, f in named
+    ]
+    prices = ipc.find_item_prices(get_all_items([f for _, f in named]))
     # Invention cost (not really correct)
     # fs = [
     #     w.find_invention_formula(w.find_blueprint(w.find_item_type_by_name(n)))
     #     for n in items
     # ]
     # fs = [f for f in fs if f]
-    priced = [
-        price_formula(
-            lambda it: ipc.find_item_price(it), f.output.item_type.name, f
-        )
-        for f in fs
-    ]
-    priced.sort(key=lambda f: (f.profit / f.input_cost), reverse=True)
+    priced = price_formulas(prices, named, args.jobs)
     for p in priced:
         p.print()
 
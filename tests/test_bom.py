@@ -0,0 +1,47 @@
+from typing import Dict, Optional
+
+from eve import bom, world
+
+
+def item(id: int) -> world.ItemType:
+    return world.ItemType(id, f"Item {id}")
+
+
+class FakeWorld:
+    def __init__(self, formulas: Dict[world.ItemType, world.Formula]):
+        self.formulas = formulas
+
+    def find_blueprint(self, it: world.ItemType) -> Optional[world.ItemType]:
+        if it not in self.formulas:
+            return None
+        return world.ItemType(it.id + 1000, category="Blueprint")
+
+    def find_formula(self, blueprint: world.ItemType) -> world.Formula:
+        return self.formulas[item(blueprint.id - 1000)]
+
+
+def formula(output: world.ItemType, quantity: int, *inputs) -> world.Formula:
+    return world.Formula(
+        world.ItemType(output.id + 1000, category="Blueprint"),
+        3600,
+        world.ItemQuantity(output, quantity),
+        [world.ItemQuantity(it, q) for it, q in inputs],
+    )
+
+
+def test_explode_is_independent_of_the_root():
+    ore, gas, alloy, part, ship, loop = [item(i) for i in range(1, 7)]
+    # Alloy and the loop are inputs of each other; the part is shared.
+    fake = FakeWorld(
+        {
+            alloy: formula(alloy, 10, (ore, 30), (loop, 2)),
+            loop: formula(loop, 5, (alloy, 1), (gas, 4)),
+            part: formula(part, 1, (alloy, 3), (gas, 7)),
+            ship: formula(ship, 1, (part, 20), (ore, 100)),
+        }
+    )
+    for it in [alloy, loop, part]:
+        from_root = bom.BillOfMaterials(fake)  # type: ignore
+        from_root.explode(ship)
+        direct = bom.BillOfMaterials(fake)  # type: ignore
+        assert from_root.explode(it) == direct.explode(it)
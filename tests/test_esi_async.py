@@ -0,0 +1,104 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+from eve import esi_async, esi_scheduler
+
+REGION_ID = 10000002
+TYPE_ID = 34
+HISTORY_ETAG = '"history-1"'
+HISTORY = [
+    {
+        "date": "2020-12-01",
+        "average": 5.0,
+        "lowest": 4.5,
+        "highest": 5.5,
+        "volume": 1000,
+        "order_count": 10,
+    }
+]
+
+
+def order(order_id: int) -> dict:
+    return {
+        "order_id": order_id,
+        "type_id": TYPE_ID,
+        "is_buy_order": True,
+        "location_id": 60003760,
+        "price": 4.0,
+        "volume_remain": 100,
+        "issued": "2020-12-01T10:00:00Z",
+    }
+
+
+BUY_PAGES = {1: [order(1), order(2)], 2: [order(3)]}
+
+
+class StubEsi(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == f"/markets/{REGION_ID}/history/":
+            if self.headers.get("If-None-Match") == HISTORY_ETAG:
+                self.reply(304, None, {"ETag": HISTORY_ETAG})
+            else:
+                self.reply(200, HISTORY, {"ETag": HISTORY_ETAG})
+        elif query.get("order_type") == "buy":
+            page = int(query.get("page", 1))
+            self.reply(200, BUY_PAGES[page], {"X-Pages": str(len(BUY_PAGES))})
+        else:
+            self.reply(404, {"error": "not found"}, {})
+
+    def reply(self, status: int, body, headers):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        headers = {
+            "Expires": "Thu, 01 Jan 2037 00:00:00 GMT",
+            "Content-Length": str(len(data)),
+            **headers,
+        }
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def esi_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubEsi)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_fetcher_against_stub_server(esi_url):
+    fetcher = esi_async.AsyncFetcher(esi_url)
+    (responses,) = fetcher.fetch_many(
+        [(TYPE_ID, None, None)], esi_scheduler.INTERACTIVE, REGION_ID
+    )
+    assert responses.type_id == TYPE_ID
+    assert responses.history.etag == HISTORY_ETAG
+    assert responses.history.expires is not None
+    assert [d["date"].isoformat() for d in responses.history.result] == [
+        "2020-12-01"
+    ]
+    # Both pages, in order.
+    assert [o["order_id"] for o in responses.buy_orders.result] == [1, 2, 3]
+    assert responses.buy_orders.pages == 2
+    # Nothing for sale: ESI answers 404, which is an empty order list.
+    assert responses.sell_orders.result == []
+
+    etags = {"history": HISTORY_ETAG}
+    (revalidated,) = fetcher.fetch_many(
+        [(TYPE_ID, etags, None)], esi_scheduler.INTERACTIVE, REGION_ID
+    )
+    assert revalidated.history.result is None
+    assert revalidated.history.etag == HISTORY_ETAG
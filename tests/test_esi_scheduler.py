@@ -0,0 +1,55 @@
+import sqlite3
+import threading
+import time
+
+from eve import db, esi_scheduler
+
+
+def test_schedulers_share_through_the_store(tmp_path):
+    store = db.ConnectionPool(str(tmp_path / "store.sqlite"))
+    interactive = esi_scheduler.EsiScheduler()
+    interactive.share(store)
+    background = esi_scheduler.EsiScheduler()
+    background.share(store)
+    route = "get_markets_region_id_orders"
+
+    taken, _ = background._schedule(route, esi_scheduler.BACKGROUND)
+    assert taken
+    interactive.acquire(route, esi_scheduler.INTERACTIVE)
+    # As if a second had passed since the background process synced.
+    background._synced -= esi_scheduler.SHARED_SYNC_INTERVAL
+    taken, _ = background._schedule(route, esi_scheduler.BACKGROUND)
+    assert not taken
+
+    interactive.record(
+        200,
+        {"X-ESI-Error-Limit-Remain": "5", "X-ESI-Error-Limit-Reset": "30"},
+    )
+    background._synced -= esi_scheduler.SHARED_SYNC_INTERVAL
+    _, wait = background._schedule(route, esi_scheduler.INTERACTIVE)
+    assert background.error_limit_remain == 5
+    assert wait > 25
+
+
+def test_busy_store_only_stalls_the_syncing_thread(tmp_path):
+    path = str(tmp_path / "store.sqlite")
+    store = db.ConnectionPool(path)
+    scheduler = esi_scheduler.EsiScheduler()
+    scheduler.share(store)
+    route = "get_markets_region_id_orders"
+    # Another process holds the store's write lock.
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    syncing = threading.Thread(
+        target=scheduler.acquire, args=(route, esi_scheduler.INTERACTIVE)
+    )
+    syncing.start()
+    while not scheduler._synced > 0:
+        time.sleep(0.01)
+    start = time.monotonic()
+    for _ in range(5):
+        scheduler.acquire(route, esi_scheduler.INTERACTIVE)
+    assert time.monotonic() - start < 1.0
+    assert syncing.is_alive()
+    other.execute("COMMIT")
+    syncing.join()
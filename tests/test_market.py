@@ -0,0 +1,215 @@
+import datetime
+import math
+import random
+import types
+
+import pytest
+
+from benchmarks import synthetic
+from eve import db, market, world
+
+
+class NoFetcher(market.MarketFetcher):
+    def __init__(self):
+        self.requested = []
+
+    def fetch_many(self, requests, priority, region_id):
+        self.requested.extend(type_id for type_id, _, _ in requests)
+        return iter([])
+
+
+def test_refresher_is_only_trusted_for_its_own_items(tmp_path):
+    store = db.ConnectionPool(str(tmp_path / "store.sqlite"))
+    now = datetime.datetime.now()
+    # Both prices were refreshed an hour ago and ESI said they expired a
+    # minute later.
+    refreshed = int((now - datetime.timedelta(hours=1)).timestamp())
+    with store.writer() as conn:
+        market.create_tables(conn)
+        with conn:
+            for type_id in [1, 2]:
+                conn.execute(
+                    "INSERT INTO eveMarket("
+                    "  type_id, region_id, location_id, last_refreshed,"
+                    "  daily_trade_volume, low_price, high_price, expires"
+                    ") VALUES (?, ?, ?, ?, 1, 1, 2, ?)",
+                    (
+                        type_id,
+                        world.JITA_REGION_ID,
+                        world.JITA_4_4_STATION_ID,
+                        refreshed,
+                        refreshed + 60,
+                    ),
+                )
+        market.record_refresher_items(
+            conn, world.JITA_REGION_ID, world.JITA_4_4_STATION_ID, [1]
+        )
+        market.record_refresher_heartbeat(
+            conn, now + datetime.timedelta(minutes=1)
+        )
+    fetcher = NoFetcher()
+    ipc = market.ItemPriceCache(store, lambda: None, fetcher=fetcher)
+    ipc.prefetch([world.ItemType(1), world.ItemType(2)])
+    assert fetcher.requested == [2]
+
+    # Without a running refresher, nothing outlives its Expires.
+    with store.writer() as conn:
+        market.record_refresher_heartbeat(
+            conn, now - datetime.timedelta(hours=1)
+        )
+    fetcher = NoFetcher()
+    ipc = market.ItemPriceCache(store, lambda: None, fetcher=fetcher)
+    ipc.prefetch([world.ItemType(1), world.ItemType(2)])
+    assert sorted(fetcher.requested) == [1, 2]
+
+
+def make_order(order_id, type_id=1, is_buy_order=False):
+    return {
+        "order_id": order_id,
+        "type_id": type_id,
+        "is_buy_order": is_buy_order,
+        "location_id": world.JITA_4_4_STATION_ID,
+        "price": 10.0 + order_id,
+        "volume_remain": 5,
+    }
+
+
+def test_region_orders_are_written_page_by_page(tmp_path):
+    store = db.ConnectionPool(str(tmp_path / "store.sqlite"))
+    with store.writer() as conn:
+        market.create_tables(conn)
+    region_id = world.JITA_REGION_ID
+    now = datetime.datetime.now()
+    market.store_region_orders(store, region_id, now, [[make_order(1)]])
+
+    def staged():
+        conn = store.reader()
+        row = conn.execute("SELECT COUNT(*) FROM eveMarketOrdersStaging")
+        return row.fetchone()[0]
+
+    def pages():
+        yield [make_order(2), make_order(3, is_buy_order=True)]
+        # The first page is already stored and the writer is free while
+        # the next one downloads, but readers still see the old book.
+        assert staged() == 2
+        assert store._write_lock.acquire(blocking=False)
+        store._write_lock.release()
+        assert market.read_region_orders(store.reader(), region_id, 1) == (
+            [],
+            [make_order(1)],
+        )
+        yield [make_order(4, type_id=2)]
+
+    market.store_region_orders(store, region_id, now, pages())
+    assert staged() == 0
+    assert market.read_region_orders(store.reader(), region_id, 1) == (
+        [make_order(3, is_buy_order=True)],
+        [make_order(2)],
+    )
+    assert market.read_region_orders(store.reader(), region_id, 2) == (
+        [],
+        [make_order(4, type_id=2)],
+    )
+
+
+# The pricing loops OrderBook replaced.
+def scan_buy_orders(buy_orders):
+    prices = [
+        (x["volume_remain"], x["price"])
+        for x in buy_orders
+        if x["is_buy_order"] and x["volume_remain"] > 0
+    ]
+    prices.sort(key=lambda p: p[1], reverse=True)
+    total_cost = 0.0
+    total_qty = 0.0
+    for p in prices:
+        total_cost += p[0] * p[1]
+        total_qty += p[0]
+        if (
+            total_cost >= market.MIN_TOTAL_COST
+            and total_qty >= market.MIN_TOTAL_QTY
+        ):
+            return p[1]
+    return 0.0
+
+
+def scan_sell_orders(sell_orders):
+    prices = [
+        (x["volume_remain"], x["price"])
+        for x in sell_orders
+        if market.is_good_sell_order(x)
+    ]
+    prices.sort(key=lambda p: p[1])
+    total_cost = 0.0
+    total_qty = 0.0
+    for p in prices:
+        total_cost += p[0] * p[1]
+        total_qty += p[0]
+        if (
+            total_cost >= market.MIN_TOTAL_COST
+            and total_qty >= market.MIN_TOTAL_QTY
+        ):
+            return p[1]
+    return math.inf
+
+
+def test_order_book_prices_match_scanning_the_orders():
+    rng = random.Random(0)
+    for n in [0, 1, 2, 5, 20, 200, 2000]:
+        for _ in range(20):
+            buy_orders = synthetic.make_orders(rng, 1, n, True)
+            sell_orders = synthetic.make_orders(rng, 1, n, False)
+            # Equal prices, empty orders and the wrong side of the book.
+            for x in rng.sample(buy_orders + sell_orders, n // 4):
+                x["price"] = rng.choice(buy_orders + sell_orders)["price"]
+            for x in rng.sample(buy_orders + sell_orders, n // 10):
+                x["volume_remain"] = 0
+            mixed = buy_orders + sell_orders
+            rng.shuffle(mixed)
+            assert market.buy_order_price(mixed) == scan_buy_orders(mixed)
+            assert market.sell_order_price(mixed) == scan_sell_orders(mixed)
+
+
+def test_fetchers_must_implement_fetch_many():
+    class Incomplete(market.MarketFetcher):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+class FakeOrdersOperation:
+    """Stands in for bravado's operation, serving pages of orders."""
+
+    operation = types.SimpleNamespace(operation_id="get_orders")
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def __call__(self, _request_options, page=1, **kwargs):
+        self.requests.append((page, _request_options))
+        headers = {"X-Pages": str(len(self.pages)), "ETag": f'"{page}"'}
+        response = types.SimpleNamespace(
+            result=list(self.pages[page - 1]),
+            incoming_response=types.SimpleNamespace(
+                headers=headers, status_code=200, raw_bytes=b""
+            ),
+        )
+        return types.SimpleNamespace(response=lambda: response)
+
+
+def test_market_orders_follow_pages():
+    pages = [[make_order(1), make_order(2)], [make_order(3)], [make_order(4)]]
+    operation = FakeOrdersOperation(pages)
+    api = types.SimpleNamespace(
+        Market=types.SimpleNamespace(get_markets_region_id_orders=operation)
+    )
+    response = market.get_market_orders(api, 1, "sell", etag='"0"')
+    assert response.result == [make_order(id) for id in [1, 2, 3, 4]]
+    assert response.etag == '"1"'
+    assert operation.requests == [
+        (1, {"headers": {"If-None-Match": '"0"'}}),
+        (2, {}),
+        (3, {}),
+    ]
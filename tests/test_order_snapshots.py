@@ -0,0 +1,174 @@
+import datetime
+import json
+
+from eve import db, market, order_snapshots, world
+
+
+def make_store(tmp_path) -> db.ConnectionPool:
+    store = db.ConnectionPool(str(tmp_path / "store.sqlite"))
+    with store.writer() as conn:
+        market.create_tables(conn)
+    return store
+
+
+def order(order_id: int, is_buy_order: bool, price: float) -> dict:
+    return {
+        "order_id": order_id,
+        "type_id": 34,
+        "is_buy_order": is_buy_order,
+        "location_id": world.JITA_4_4_STATION_ID,
+        "price": price,
+        "volume_remain": 100 + order_id,
+    }
+
+
+def book(n: int):
+    # Every snapshot reprices one order, fills one and lists a new one.
+    buy_orders = [
+        order(id, True, 5.0 + 0.01 * n * (id == n + 1))
+        for id in range(n, n + 3)
+    ]
+    sell_orders = [
+        order(id, False, 6.0 + 0.5 * id) for id in range(1000 + n, 1002 + n)
+    ]
+    return buy_orders, sell_orders
+
+
+def by_id(orders):
+    return sorted(orders, key=lambda x: x["order_id"])
+
+
+def snapshot_times(start: datetime.datetime, n: int, step: datetime.timedelta):
+    return [start + i * step for i in range(n)]
+
+
+def store_books(conn, times):
+    with conn:
+        for n, t in enumerate(times):
+            order_snapshots.store_order_snapshot(conn, 34, t, *book(n))
+
+
+def test_snapshots_read_back_across_keyframes(tmp_path):
+    store = make_store(tmp_path)
+    times = snapshot_times(
+        datetime.datetime(2024, 1, 1), 30, datetime.timedelta(hours=1)
+    )
+    with store.writer() as conn:
+        store_books(conn, times)
+        keyframes = [
+            r[0]
+            for r in conn.execute(
+                "SELECT is_keyframe FROM eveOrderSnapshot "
+                "ORDER BY retrieved_on"
+            )
+        ]
+    interval = order_snapshots.KEYFRAME_INTERVAL
+    assert keyframes == [i % interval == 0 for i in range(len(times))]
+    for n, t in enumerate(times):
+        snapshot = order_snapshots.read_order_snapshot(store.reader(), 34, t)
+        assert snapshot is not None
+        retrieved_on, buy_orders, sell_orders = snapshot
+        assert retrieved_on == t
+        assert by_id(buy_orders) == book(n)[0]
+        assert by_id(sell_orders) == book(n)[1]
+
+
+def test_compaction_keeps_recent_snapshots_readable(tmp_path):
+    store = make_store(tmp_path)
+    now = datetime.datetime.now().replace(microsecond=0)
+    retention_days = 10
+    # Twice a day for three weeks, so the cutoff lands between keyframes.
+    times = snapshot_times(
+        now - datetime.timedelta(days=21), 42, datetime.timedelta(hours=12)
+    )
+    cutoff = now - datetime.timedelta(days=retention_days)
+    with store.writer() as conn:
+        store_books(conn, times)
+        order_snapshots.compact_order_snapshots(conn, retention_days)
+    conn = store.reader()
+    kept = conn.execute(
+        "SELECT retrieved_on, is_keyframe FROM eveOrderSnapshot "
+        "ORDER BY retrieved_on"
+    ).fetchall()
+    assert [datetime.datetime.fromtimestamp(r[0]) for r in kept] == [
+        t for t in times if t >= cutoff
+    ]
+    # The first kept snapshot was a delta on a dropped keyframe.
+    assert kept[0]["is_keyframe"]
+    for n, t in enumerate(times):
+        if t < cutoff:
+            continue
+        _, buy_orders, sell_orders = order_snapshots.read_order_snapshot(
+            conn, 34, t
+        )
+        assert by_id(buy_orders) == book(n)[0]
+        assert by_id(sell_orders) == book(n)[1]
+
+
+def test_baseline_store_is_migrated(tmp_path):
+    store = db.ConnectionPool(str(tmp_path / "store.sqlite"))
+    times = snapshot_times(
+        datetime.datetime.now().replace(microsecond=0)
+        - datetime.timedelta(days=2),
+        30,
+        datetime.timedelta(hours=1),
+    )
+    history = [
+        {
+            "date": "2024-01-01",
+            "average": 5.5,
+            "lowest": 5.0,
+            "highest": 6.0,
+            "volume": 1000,
+            "order_count": 10,
+        }
+    ]
+    # The store as the first version of the tool left it.
+    with store.writer() as conn, conn:
+        conn.execute(
+            "CREATE TABLE eveMarket ("
+            "  type_id INTEGER PRIMARY KEY NOT NULL,"
+            "  last_refreshed INTEGER NOT NULL,"
+            "  daily_trade_volume REAL NOT NULL,"
+            "  low_price REAL NOT NULL,"
+            "  high_price REAL NOT NULL,"
+            "  history JSON NOT NULL"
+            ")"
+        )
+        conn.execute(
+            "CREATE TABLE eveMarketHistory ("
+            "  type_id INTEGER NOT NULL,"
+            "  retrieved_on INTEGER NOT NULL,"
+            "  buy_orders JSON NOT NULL,"
+            "  sell_orders JSON NOT NULL,"
+            "  PRIMARY KEY (type_id, retrieved_on)"
+            ")"
+        )
+        conn.execute(
+            "INSERT INTO eveMarket VALUES (34, ?, 1000, 5.0, 6.0, ?)",
+            (int(times[-1].timestamp()), json.dumps(history)),
+        )
+        conn.executemany(
+            "INSERT INTO eveMarketHistory VALUES (34, ?, ?, ?)",
+            (
+                (int(t.timestamp()), *(json.dumps(x) for x in book(n)))
+                for n, t in enumerate(times)
+            ),
+        )
+
+    with store.writer() as conn:
+        market.create_tables(conn)
+        order_snapshots.compact_order_snapshots(conn)
+    conn = store.reader()
+    assert not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'eveMarketHistory'"
+    ).fetchone()
+    for n, t in enumerate(times):
+        _, buy_orders, sell_orders = order_snapshots.read_order_snapshot(
+            conn, 34, t
+        )
+        assert by_id(buy_orders) == book(n)[0]
+        assert by_id(sell_orders) == book(n)[1]
+    assert market.read_item_prices(conn, [34])[34]["high_price"] == 6.0
+    series = market.read_histories(conn, [34], None, None)[34]
+    assert [d.average for d in series] == [5.5]
@@ -0,0 +1,200 @@
+import pytest
+
+from benchmarks import synthetic
+from eve import bom, db, market, world
+
+import reactor
+
+
+def item(id: int, volume_m3: float = 1.0) -> world.ItemType:
+    return world.ItemType(id, f"Item {id}", volume_m3=volume_m3)
+
+
+def formula(output: world.ItemQuantity, *inputs) -> world.Formula:
+    return world.Formula(
+        world.ItemType(output.item_type.id + 1000), 3600, output, list(inputs)
+    )
+
+
+def plan_cost(priced: reactor.PricedFormula) -> float:
+    input_m3 = sum(
+        i.quantity * i.item_type.volume_m3 for i in priced.formula.inputs
+    )
+    return (
+        priced.input_cost
+        + priced.job_cost
+        + input_m3 * reactor.SHIPMENT_COST_PER_M3
+    )
+
+
+def test_fold_search_costs_match_price_formula():
+    rock, gas, dust, fuel = item(1), item(2, 0.01), item(3), item(4)
+    block, product = item(10), item(11)
+    # One run of the product takes a tenth of a block run, so the block's
+    # inputs come to fractions of a unit that get charged as whole ones.
+    formulas = [
+        formula(
+            world.ItemQuantity(block, 100),
+            world.ItemQuantity(rock, 3),
+            world.ItemQuantity(gas, 250),
+        ),
+        formula(
+            world.ItemQuantity(product, 1),
+            world.ItemQuantity(block, 10),
+            world.ItemQuantity(dust, 0.5),
+            world.ItemQuantity(fuel, 20),
+        ),
+    ]
+    prices = {
+        it: market.ItemPrice(it.id, low_price=p, high_price=p)
+        for it, p in [
+            (rock, 5000.0),
+            (gas, 20.0),
+            (dust, 300.0),
+            (fuel, 15.0),
+            (block, 150.0),
+            (product, 5000.0),
+        ]
+    }
+    search = reactor.FoldSearch(
+        {f.output.item_type.id: f for f in formulas}, prices.__getitem__
+    )
+    plans = search.plans(formulas[1])
+    assert len(plans) == 2
+    for plan in plans:
+        folded = search.apply(formulas[1], plan)
+        priced = reactor.price_formula(prices.__getitem__, "", folded)
+        assert plan.cost == pytest.approx(plan_cost(priced))
+
+
+def test_watched_items_reach_every_level(tmp_path):
+    path = str(tmp_path / "reference.sqlite")
+    synthetic.create_reference_db(
+        path, synthetic.Shape(raw_items=20, formulas=5, depth=3)
+    )
+    w = world.World(db.connect_reference(path), preload=True)
+    b = bom.BillOfMaterials(w)
+    product = w.find_item_type_by_name("Tier 3 Product 0")
+    watched = reactor.watched_items(b, [product.name])
+    assert product in watched
+    # Everything two steps below the product: inputs of its inputs.
+    second_level = {
+        i.item_type
+        for inp in b.find_formula(product).inputs
+        if b.find_formula(inp.item_type)
+        for i in b.find_formula(inp.item_type).inputs
+    }
+    assert second_level
+    assert second_level <= watched
+
+
+def test_fold_search_shares_only_plans_without_cycle_cuts():
+    rock, gas = item(1), item(2)
+    part, module, ship = item(10), item(11), item(12)
+    # The part and the module are each made from the other, and both
+    # products take the part.
+    formulas = [
+        formula(
+            world.ItemQuantity(part, 1),
+            world.ItemQuantity(module, 1),
+            world.ItemQuantity(rock, 2),
+        ),
+        formula(
+            world.ItemQuantity(module, 1),
+            world.ItemQuantity(part, 1),
+            world.ItemQuantity(gas, 3),
+        ),
+        formula(
+            world.ItemQuantity(ship, 1),
+            world.ItemQuantity(part, 1),
+            world.ItemQuantity(gas, 1),
+        ),
+    ]
+    prices = {
+        it: market.ItemPrice(it.id, low_price=p, high_price=p)
+        for it, p in [
+            (rock, 1.0),
+            (gas, 2.0),
+            (part, 400.0),
+            (module, 900.0),
+            (ship, 5000.0),
+        ]
+    }
+    by_output = {f.output.item_type.id: f for f in formulas}
+    module_formula, ship_formula = formulas[1], formulas[2]
+    shared = reactor.FoldSearch(by_output, prices.__getitem__)
+    # Searching from the module buys it wherever the part needs one.
+    shared.plans(module_formula)
+    alone = reactor.FoldSearch(by_output, prices.__getitem__)
+    assert shared.plans(ship_formula) == alone.plans(ship_formula)
+    assert any(
+        sub.folds
+        for plan in shared.plans(ship_formula)
+        for _, sub in plan.folds
+    )
+
+
+def synthetic_market(tmp_path, shape: synthetic.Shape):
+    """Folds of every synthetic formula and the history of every item."""
+    reference_path = str(tmp_path / "reference.sqlite")
+    store_path = str(tmp_path / "store.sqlite")
+    universe = synthetic.create_reference_db(reference_path, shape)
+    synthetic.create_store_db(store_path, universe, shape)
+    w = world.World(db.connect_reference(reference_path), preload=True)
+    formulas = reactor.fold_all_formulas(
+        [w.find_formula(w.find_item_type(id)) for id in universe.blueprint_ids]
+    )
+    hist = {
+        w.find_item_type(id): s
+        for id, s in market.read_histories(
+            db.ConnectionPool(store_path).reader(), universe.traded_ids
+        ).items()
+    }
+    return formulas, hist
+
+
+def test_backtest_matches_price_formula(tmp_path):
+    shape = synthetic.Shape(raw_items=20, formulas=6, depth=3, days=30)
+    formulas, hist = synthetic_market(tmp_path, shape)
+    dates = reactor.get_common_dates(hist)
+    assert len(dates) == shape.days
+    assert any(f.intermediates for _, f in formulas)
+
+    pm = reactor.build_price_matrix(hist, dates)
+    cf = reactor.compile_formulas(formulas, pm.items)
+    profits, profit_ratios = reactor.backtest_formulas(pm, cf)
+    for j, d in enumerate(dates):
+        ips = reactor.get_price_snapshot(hist, d)
+        for i, (name, f) in enumerate(formulas):
+            priced = reactor.price_formula(ips, name, f)
+            assert profits[i, j] == priced.profit
+            assert profit_ratios[i, j] == priced.profit_ratio
+
+
+def test_price_formulas_on_workers_matches_serial(tmp_path):
+    shape = synthetic.Shape(raw_items=20, formulas=10, depth=3, days=5)
+    formulas, hist = synthetic_market(tmp_path, shape)
+    ips = reactor.get_price_snapshot(hist, reactor.get_common_dates(hist)[-1])
+    prices = {it: ips(it) for it in hist}
+
+    def numbers(priced):
+        return [
+            (
+                p.name,
+                p.formula,
+                p.daily_volume_in_runs,
+                p.profit,
+                p.input_cost,
+                p.job_cost,
+            )
+            for p in priced
+        ]
+
+    serial = reactor.price_formulas(prices, formulas, jobs=1)
+    assert len(serial) == len(formulas)
+    for jobs in [2, 3]:
+        parallel = reactor.price_formulas(prices, formulas, jobs=jobs)
+        assert numbers(parallel) == numbers(serial)
+        # What print() looks up for each formula.
+        for p, q in zip(parallel, serial):
+            assert {it: p.prices[it] for it in q.prices} == q.prices
@@ -0,0 +1,101 @@
+import sqlite3
+
+from benchmarks import synthetic
+from eve import db, world
+
+MANUFACTURING_GROUP_ID = 4
+
+
+def create_reference_db(path: str) -> synthetic.Universe:
+    universe = synthetic.create_reference_db(
+        path, synthetic.Shape(raw_items=30, formulas=15, depth=3)
+    )
+    raw, product = universe.raw_ids[0], universe.product_ids[0]
+    blueprint, reaction = universe.blueprint_ids[-1] + 1, 45000
+    manufacturing = world.INDUSTRY_ACTIVITY_MANUFACTURING
+    reactions = world.INDUSTRY_ACTIVITY_REACTIONS
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "INSERT INTO invGroups VALUES (?, 'Composite Blueprints', ?)",
+            (MANUFACTURING_GROUP_ID, synthetic.BLUEPRINT_CATEGORY_ID),
+        )
+        conn.executemany(
+            "INSERT INTO invTypes VALUES (?, ?, ?, 0.01)",
+            [
+                # A second way to make a product that already has one.
+                (
+                    blueprint,
+                    "Tier 1 Product 0 Blueprint",
+                    MANUFACTURING_GROUP_ID,
+                ),
+                (
+                    world.TEST_REACTION_BLUEPRINT_ID,
+                    "Test Reaction",
+                    synthetic.FORMULA_GROUP_ID,
+                ),
+                # A reaction formula that also lists a manufacturing job.
+                (reaction, "Odd Reaction Formula", synthetic.FORMULA_GROUP_ID),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO industryActivity VALUES (?, ?, ?)",
+            [
+                (blueprint, manufacturing, 600),
+                (world.TEST_REACTION_BLUEPRINT_ID, reactions, 60),
+                (reaction, manufacturing, 100),
+                (reaction, reactions, 200),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO industryActivityMaterials VALUES (?, ?, ?, ?)",
+            [
+                (blueprint, manufacturing, raw, 7),
+                (blueprint, manufacturing, universe.raw_ids[1], 3),
+                (world.TEST_REACTION_BLUEPRINT_ID, reactions, raw, 1),
+                (reaction, manufacturing, raw, 9),
+                (reaction, reactions, raw, 5),
+                (reaction, reactions, product, 2),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO industryActivityProducts VALUES (?, ?, ?, ?)",
+            [
+                (blueprint, manufacturing, product, 1),
+                (world.TEST_REACTION_BLUEPRINT_ID, reactions, product, 1),
+                (reaction, manufacturing, universe.product_ids[1], 1),
+                (reaction, reactions, universe.product_ids[2], 10),
+            ],
+        )
+    conn.close()
+    return universe
+
+
+def formula_or_error(w: world.World, it: world.ItemType):
+    try:
+        return w.find_formula(it)
+    except (ValueError, world.FormulaNotFound) as e:
+        return type(e)
+
+
+def test_formula_index_matches_queries(tmp_path):
+    path = str(tmp_path / "reference.sqlite")
+    create_reference_db(path)
+    queried = world.World(db.connect_reference(path), preload=True)
+    indexed = world.World(db.connect_reference(path), preload=True)
+    index = indexed.load_formula_index()
+    assert world.TEST_REACTION_BLUEPRINT_ID in index.by_blueprint
+
+    type_ids = [
+        r[0] for r in queried.conn.execute("SELECT typeID FROM invTypes")
+    ]
+    for type_id in type_ids:
+        it = queried.find_item_type(type_id)
+        assert indexed.find_blueprint(it) == queried.find_blueprint(it)
+        assert formula_or_error(indexed, it) == formula_or_error(queried, it)
+        # The query collects blueprints in a set, so only membership counts.
+        assert sorted(
+            indexed.find_material_uses(it), key=lambda f: f.blueprint.id
+        ) == sorted(
+            queried.find_material_uses(it), key=lambda f: f.blueprint.id
+        )